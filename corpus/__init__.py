@@ -7,7 +7,12 @@ from .corpus import (
     Corpus,
     RandomSampleCorpus,
     LazyCorpus,
-    LazyRandomSampleCorpus
+    LazyRandomSampleCorpus,
+    StreamingCorpus
 )
+from .packing import PackedCorpus
+from .mixture import MixtureCorpus, StreamingMixtureCorpus
+from .collate import DataCollator
+from .sampler import ResampleSampler, LengthGroupedBatchSampler
 
 from .stat import stat
\ No newline at end of file
@@ -0,0 +1,333 @@
+from itertools import chain
+import numpy as np
+import shutil
+import json
+import os
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+"""
+<cache_dir>/<signature>/
+    meta.json           {"num_samples": N, "keys": {...}, "segments": [...],
+                         "byte_offset": ..., "exhausted": ..., "complete": true}
+    seg-00000/
+        meta.json       {"num_samples": n, "keys": {"input_ids": "int32", ...}}
+        input_ids.bin   flat token buffer of all samples in the segment
+        input_ids.idx   uint64 offsets, n + 1 entries
+        ...
+    seg-00001/
+    ...
+
+Segments of the `arrow` format hold a single `data.arrow` instead, an arrow
+ipc stream with one `list<int32>` column per key, readable by other tools
+(e.g. `datasets.Dataset.from_file`).
+
+While a corpus is being built, `complete` is false and `byte_offset` marks
+how far into the source the stored segments reach (bytes of jsonl, rows of
+columnar sources). `exhausted` is set once they reach its end.
+"""
+
+
+META_FILE = 'meta.json'
+INDEX_DTYPE = np.uint64
+TOKEN_DTYPE = np.int32
+FLUSH_EVERY = 4096
+SEGMENT_SIZE = 16384
+ARROW_FILE = 'data.arrow'
+CACHE_FORMATS = ('bin', 'arrow')
+
+
+def read_meta(path):
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+
+def write_meta(path, meta):
+    tmp_path = os.path.join(path, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
+
+
+def cache_exists(path):
+    meta = read_meta(path)
+    return meta is not None and meta['complete']
+
+
+def _open_buffer(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class SampleArrays:
+    # all samples in one flat buffer per key, `__getitem__` returns views
+    def __init__(self, buffers, offsets, num_samples):
+        self.buffers = buffers
+        self.offsets = offsets
+        self.num_samples = num_samples
+
+
+    @classmethod
+    def from_samples(cls, samples):
+        buffers, offsets = {}, {}
+        keys = samples[0].keys() if len(samples) > 0 else []
+        for key in keys:
+            lengths = np.fromiter((len(sample[key]) for sample in samples), dtype=np.int64, count=len(samples))
+            offsets[key] = np.concatenate([[0], np.cumsum(lengths)]).astype(INDEX_DTYPE)
+            buffers[key] = np.fromiter(
+                chain.from_iterable(sample[key] for sample in samples), 
+                dtype=TOKEN_DTYPE, 
+                count=int(lengths.sum()))
+        return cls(buffers, offsets, len(samples))
+
+
+    def __len__(self):
+        return self.num_samples
+
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_samples
+        if not 0 <= index < self.num_samples:
+            raise IndexError(index)
+
+        sample = {}
+        for key, buffer in self.buffers.items():
+            offsets = self.offsets[key]
+            sample[key] = buffer[int(offsets[index]):int(offsets[index + 1])]
+        return sample
+
+
+    def __iter__(self):
+        for index in range(self.num_samples):
+            yield self[index]
+
+
+    def lengths(self, key='input_ids'):
+        return np.diff(self.offsets[key]).astype(np.int64)[:self.num_samples]
+
+
+def check_format(format):
+    if format not in CACHE_FORMATS:
+        raise ValueError(f"unknown cache format `{format}`, expected one of {CACHE_FORMATS}")
+    if format == 'arrow' and pa is None:
+        raise ImportError("the `arrow` cache format requires `pyarrow`, install `corpus[arrow]`")
+
+
+class Segment(SampleArrays):
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_meta(path)
+        if self.meta.get('format', 'bin') == 'arrow':
+            buffers, offsets = self.open_arrow()
+        else:
+            buffers, offsets = {}, {}
+            for key, dtype in self.meta['keys'].items():
+                buffers[key] = _open_buffer(os.path.join(path, f"{key}.bin"), np.dtype(dtype))
+                offsets[key] = _open_buffer(os.path.join(path, f"{key}.idx"), INDEX_DTYPE)
+        super().__init__(buffers, offsets, self.meta['num_samples'])
+
+
+    def open_arrow(self):
+        # zero-copy views into the memory-mapped record batch
+        source = pa.memory_map(os.path.join(self.path, ARROW_FILE), 'r')
+        table = pa.ipc.open_stream(source).read_all()
+        buffers, offsets = {}, {}
+        for key in self.meta['keys']:
+            array = table.column(key).chunk(0)
+            buffers[key] = array.values.to_numpy(zero_copy_only=True)
+            offsets[key] = array.offsets.to_numpy(zero_copy_only=True)
+        return buffers, offsets
+
+
+class SampleStore:
+    def __init__(self, path, max_samples=None):
+        self.path = path
+        self.meta = read_meta(path)
+        self.segments = [Segment(os.path.join(path, name)) for name in self.meta['segments']]
+        self.bounds = np.cumsum([0] + [len(segment) for segment in self.segments])
+        self.num_samples = int(self.bounds[-1])
+        if max_samples is not None:
+            self.num_samples = int(min(self.num_samples, max_samples))
+
+
+    def __len__(self):
+        return self.num_samples
+
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_samples
+        if not 0 <= index < self.num_samples:
+            raise IndexError(index)
+
+        i = int(np.searchsorted(self.bounds, index, side='right')) - 1
+        return self.segments[i][index - int(self.bounds[i])]
+
+
+    def __iter__(self):
+        for index in range(self.num_samples):
+            yield self[index]
+
+
+    def lengths(self, key='input_ids'):
+        lengths = [segment.lengths(key) for segment in self.segments]
+        return np.concatenate(lengths)[:self.num_samples] if lengths else np.empty(0, np.int64)
+
+
+def write_bin(path, samples):
+    files, offsets, chunks = {}, {}, {}
+    num_samples = 0
+
+    def flush():
+        for key, chunk in chunks.items():
+            if chunk:
+                np.concatenate(chunk).astype(TOKEN_DTYPE, copy=False).tofile(files[key])
+            chunks[key] = []
+
+    try:
+        for sample in samples:
+            if not files:
+                for key in sample.keys():
+                    files[key] = open(os.path.join(path, f"{key}.bin"), 'wb')
+                    offsets[key] = [0]
+                    chunks[key] = []
+
+            if sample.keys() != files.keys():
+                raise ValueError(f"sample keys {list(sample.keys())} differ from {list(files.keys())}")
+
+            for key, value in sample.items():
+                value = np.asarray(value, dtype=TOKEN_DTYPE)
+                if value.ndim != 1:
+                    raise ValueError(f"`{key}` is not a flat list of integers")
+                chunks[key].append(value)
+                offsets[key].append(offsets[key][-1] + len(value))
+
+            num_samples += 1
+            if num_samples % FLUSH_EVERY == 0:
+                flush()
+        flush()
+
+    finally:
+        for f in files.values():
+            f.close()
+
+    for key, offset in offsets.items():
+        np.asarray(offset, dtype=INDEX_DTYPE).tofile(os.path.join(path, f"{key}.idx"))
+
+    return {
+        "num_samples": num_samples,
+        "keys": {key: np.dtype(TOKEN_DTYPE).name for key in files.keys()}}
+
+
+def write_arrow(path, samples):
+    # a single record batch of `list<int32>` columns, `large_list<int32>`
+    # once a column outgrows 32 bit offsets
+    arrays = SampleArrays.from_samples(samples)
+    columns = {}
+    for key, buffer in arrays.buffers.items():
+        offsets = arrays.offsets[key].astype(np.int64)
+        if offsets[-1] < np.iinfo(np.int32).max:
+            columns[key] = pa.ListArray.from_arrays(pa.array(offsets.astype(np.int32)), pa.array(buffer))
+        else:
+            columns[key] = pa.LargeListArray.from_arrays(pa.array(offsets), pa.array(buffer))
+    batch = pa.RecordBatch.from_pydict(columns)
+
+    with pa.OSFile(os.path.join(path, ARROW_FILE), 'wb') as sink:
+        with pa.ipc.new_stream(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+
+    return {
+        "num_samples": len(arrays),
+        "keys": {key: np.dtype(TOKEN_DTYPE).name for key in columns.keys()},
+        "format": "arrow"}
+
+
+def write_samples(path, samples, format='bin'):
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.mkdir(tmp_path)
+
+    meta = write_arrow(tmp_path, samples) if format == 'arrow' else write_bin(tmp_path, samples)
+    write_meta(tmp_path, meta)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return meta
+
+
+class CacheWriter:
+    def __init__(self, path, resume=False, segment_size=SEGMENT_SIZE, format='bin'):
+        check_format(format)
+        self.path = path
+        self.segment_size = segment_size
+        self.format = format
+        self.pending = []
+
+        self.meta = read_meta(path) if resume else None
+        if self.meta is None:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.mkdir(path)
+            self.meta = {
+                "num_samples": 0,
+                "keys": {},
+                "segments": [],
+                "byte_offset": 0,
+                "exhausted": False,
+                "complete": False}
+        self.meta['complete'] = False
+        self.consumed = self.meta['byte_offset']
+        self.exhausted = self.meta.get('exhausted', False)
+        write_meta(path, self.meta)
+
+
+    @property
+    def byte_offset(self):
+        return self.meta['byte_offset']
+
+
+    def stored_samples(self):
+        return SampleStore(self.path)
+
+
+    def append(self, sample):
+        self.pending.append(sample)
+
+
+    def commit(self, byte_offset, exhausted=False):
+        # the source is consumed up to `byte_offset` by all appended samples,
+        # or entirely when `exhausted`
+        self.consumed = byte_offset
+        self.exhausted = exhausted
+        if len(self.pending) >= self.segment_size:
+            self.flush()
+
+
+    def flush(self):
+        if self.pending:
+            name = f"seg-{len(self.meta['segments']):05d}"
+            segment_meta = write_samples(os.path.join(self.path, name), self.pending, format=self.format)
+            self.meta['segments'].append(name)
+            self.meta['num_samples'] += segment_meta['num_samples']
+            self.meta['keys'] = segment_meta['keys']
+            self.pending = []
+        self.meta['byte_offset'] = self.consumed
+        self.meta['exhausted'] = self.exhausted
+        write_meta(self.path, self.meta)
+
+
+    def close(self):
+        self.flush()
+        self.meta['complete'] = True
+        write_meta(self.path, self.meta)
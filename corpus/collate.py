@@ -0,0 +1,77 @@
+from .utils import expand_label_spans
+
+import numpy as np
+import torch
+
+
+def convert_sample(sample, return_tensors=None):
+    if sample is None:
+        return None
+    elif return_tensors is None:
+        return {key: value.tolist() if isinstance(value, (np.ndarray, torch.Tensor)) else value
+                for key, value in sample.items()}
+    elif return_tensors == 'np':
+        return {key: np.asarray(value) for key, value in sample.items()}
+    elif return_tensors == 'pt':
+        return {key: torch.tensor(np.asarray(value), dtype=torch.int64) for key, value in sample.items()}
+    else: raise NotImplementedError
+
+
+class DataCollator:
+    def __init__(self, pad_token_id, pad_side='left', pad_to_multiple_of=None):
+        self.pad_side = pad_side
+        self.pad_to_multiple_of = pad_to_multiple_of
+        # same padding values as `BasicProcessor.padding`
+        self.pad_values = {
+            "input_ids": pad_token_id,
+            "labels": -100,
+            "attention_mask": 1,
+            "position_ids": 0}
+
+
+    @classmethod
+    def from_processor(cls, processor, pad_to_multiple_of=None):
+        return cls(
+            processor.tokenizer.pad_token_id, 
+            pad_side=processor.pad_side, 
+            pad_to_multiple_of=pad_to_multiple_of)
+
+
+    def pad(self, key, values):
+        max_length = max(len(value) for value in values)
+        if self.pad_to_multiple_of is not None:
+            max_length = -(-max_length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch = torch.full((len(values), max_length), self.pad_values.get(key, 0), dtype=torch.int64)
+        for i, value in enumerate(values):
+            value = torch.as_tensor(np.asarray(value, dtype=np.int64))
+            if self.pad_side == 'left':
+                batch[i, max_length - len(value):] = value
+            elif self.pad_side == 'right':
+                batch[i, :len(value)] = value
+            else: raise NotImplementedError
+        return batch
+
+
+    def __call__(self, samples):
+        batch = {}
+        for key in samples[0].keys():
+            if key == 'label_spans':
+                batch['labels'] = self.pad('labels', [
+                    expand_label_spans(sample['input_ids'], sample['label_spans']) 
+                    for sample in samples])
+            elif key != 'cu_seqlens':
+                batch[key] = self.pad(key, [sample[key] for sample in samples])
+
+        if 'cu_seqlens' in samples[0]:
+            # packed rows: boundaries of the flattened batch, as flash-attention expects
+            row_length = batch['input_ids'].shape[1]
+            cu_seqlens = [0]
+            for i, sample in enumerate(samples):
+                shift = i * row_length + (row_length - len(sample['input_ids']) if self.pad_side == 'left' else 0)
+                cu_seqlens += [shift + int(x) for x in sample['cu_seqlens'] if shift + int(x) > cu_seqlens[-1]]
+            if cu_seqlens[-1] < batch['input_ids'].numel():
+                cu_seqlens.append(batch['input_ids'].numel())
+            batch['cu_seqlens'] = torch.tensor(cu_seqlens, dtype=torch.int32)
+
+        return batch
@@ -1,14 +1,68 @@
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from abc import abstractmethod, ABC
-from .utils import corpus_log
+from .utils import corpus_log, reservoir_sample, file_fingerprint
+from .reader import open_reader, ColumnarReader
+from .cache import SampleStore, SampleArrays, CacheWriter, cache_exists, read_meta, check_format
+from .index import open_index, load_line_offsets
+from .sampler import ResampleSampler
+from .collate import convert_sample
 
 from pygments import console
+import torch.distributed as dist
+import numpy as np
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+import multiprocessing
 import hashlib
 import random
-import json
 import time
 import os
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+CHUNKS_PER_WORKER = 16
+
+
+def _init_worker(processor):
+    global _worker_processor
+    _worker_processor = processor
+
+
+def _process_range(args):
+    reader, start, end, limit, batch_size = args
+    results = []
+    records = reader.iter_records(start, end)
+    while batch := list(islice(records, int(min(batch_size, limit - len(results))))):
+        offsets, instances = zip(*batch)
+        for offset, result in zip(offsets, _worker_processor.process_batch(list(instances))):
+            if result is not None:
+                results.append((offset, result))
+    return results
+
+
+def _process_batch(instances):
+    return _worker_processor.process_batch(instances)
+
+
+def shard_info():
+    # (shard id, number of shards) of the current dataloader worker across ranks
+    rank, world_size = 0, 1
+    if dist.is_available() and dist.is_initialized():
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+
+    worker_info = get_worker_info()
+    worker_id, num_workers = (
+        (0, 1) 
+        if worker_info is None 
+        else (worker_info.id, worker_info.num_workers))
+
+    return rank * num_workers + worker_id, world_size * num_workers
+
 
 class Flag:
     def __init__(self):
@@ -16,48 +70,118 @@ class Flag:
 
 
 class BasicCorpus(Dataset, ABC):
+    # corpora that consume the source front to back can resume a partial build,
+    # their cache holds a prefix of the output and is shared by all `max_instance`
+    resumable = False
+
+
     def __init__(
             self, 
             json_path, 
             processor, 
             max_instance=None,
             use_cache=True,
-            cache_dir='data_cache'):
+            cache_dir='data_cache',
+            batch_size=256,
+            return_tensors=None,
+            json_backend=None,
+            cache_format='bin'):
 
+        check_format(cache_format)
         self.max_instance = self.inf if max_instance is None else max_instance
         self.json_path = json_path
         self.processor = processor
+        self.reader = open_reader(json_path, fields=getattr(processor, 'fields', None), backend=json_backend)
         self.cache_dir = cache_dir
+        self.cache_format = cache_format
+        if use_cache and not self.cacheable:
+            corpus_log(f"{self.__class__.__name__} is not cached with these arguments, e.g. without a seed.")
+            use_cache = False
         self.use_cache = use_cache
-
-        self.signature = hashlib.sha256(
-            f"{self.__class__.__name__}/{self.json_path}/{self.max_instance}/{self.processor.signature}".encode()
-        ).hexdigest()
+        self.batch_size = batch_size
+        self.return_tensors = return_tensors
+
+        # keyed by content rather than path, so caches are shared across jobs
+        self.source_fingerprint = file_fingerprint(self.json_path)
+        max_instance = 'prefix' if self.resumable else self.max_instance
+        signature = f"{self.__class__.__name__}/{self.source_fingerprint}/{max_instance}/{self.processor.signature}"
+        if cache_format != 'bin':
+            signature += f"/{cache_format}"
+        if (cache_key := self.cache_key()) is not None:
+            signature += f"/{cache_key}"
+        self.signature = hashlib.sha256(signature.encode()).hexdigest()
         self.data = []
+        self.writer = None
+        self.resume_offset = 0
+        # samples a resumed build already stored, `data` only holds the new ones
+        self.num_stored = 0
 
         if use_cache and not os.path.isdir(self.cache_dir):
             os.mkdir(self.cache_dir)
 
-        # load data
-        if self.use_cache and self.is_checkpoint_exists():
-            self.load()
-        else:
-            self.sample_data()
-        self.print_final_info()
-
-        # dump data
-        if self.use_cache and not self.is_checkpoint_exists():
-            self.dump()
+        with self.cache_lock():
+            # load data
+            loaded = self.use_cache and self.is_checkpoint_exists()
+            if loaded:
+                self.load()
+            else:
+                if self.use_cache and self.resumable:
+                    self.open_writer()
+                self.sample_data()
+            self.print_final_info()
+
+            # dump data
+            if self.use_cache and not loaded:
+                self.dump()
+
+            # keep samples in a few flat buffers, so forked DataLoader workers
+            # share the pages instead of copying them on refcount updates; a
+            # cached build, resumed ones included, is reloaded whole
+            if isinstance(self.data, list):
+                if self.use_cache and self.is_checkpoint_exists():
+                    self.load()
+                else:
+                    self.data = SampleArrays.from_samples(self.data)
 
 
     @property
     def inf(self):
         return 1e12
+
+
+    @property
+    def cacheable(self):
+        return True
+
+
+    def cache_key(self):
+        # arguments of a subclass that change its samples, part of the signature
+        return None
     
 
     @property
     def checkpoint_path(self):
-        return os.path.join(self.cache_dir, f"{self.signature}.json")
+        return os.path.join(self.cache_dir, self.signature)
+
+
+    @contextmanager
+    def cache_lock(self):
+        # One job at a time builds or resumes a cache, jobs sharing `cache_dir`
+        # wait for it and load what it stored.
+        if not self.use_cache or fcntl is None:
+            yield
+            return
+
+        with open(self.checkpoint_path + '.lock', 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                corpus_log(f"Waiting for another job building `{self.checkpoint_path}` ...")
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
 
 
     @abstractmethod
@@ -66,38 +190,58 @@ class BasicCorpus(Dataset, ABC):
 
 
     def is_checkpoint_exists(self):
-        return os.path.exists(self.checkpoint_path)
+        return cache_exists(self.checkpoint_path)
 
 
     def load(self):
         assert os.path.isdir(self.cache_dir), f"`{self.cache_dir}` is not existing."
         assert self.is_checkpoint_exists(), f"checkpoint not exists"
-        with open(self.checkpoint_path, 'r') as f:
-            for line in f:
-                if line and line.strip() != '':
-                    data = json.loads(line)
-                    self.data.append(data)
-                    self.print_process_info()
+        self.data = SampleStore(self.checkpoint_path)
+
+    
+    def open_writer(self):
+        self.writer = CacheWriter(self.checkpoint_path, resume=True, format=self.cache_format)
+        if self.writer.byte_offset > 0:
+            self.num_stored = len(self.writer.stored_samples())
+            self.resume_offset = self.writer.byte_offset
+            corpus_log(f"Resuming from {self.num_stored} samples at byte {self.resume_offset} ...")
+
+
+    @property
+    def num_samples(self):
+        return self.num_stored + len(self.data)
+
+
+    def append(self, result):
+        self.data.append(result)
+        if self.writer is not None:
+            self.writer.append(result)
+
+
+    def checkpoint(self, byte_offset, exhausted=False):
+        if self.writer is not None:
+            self.writer.commit(byte_offset, exhausted=exhausted)
 
     
     def dump(self):
         assert os.path.isdir(self.cache_dir), f"`{self.cache_dir}` is not existing."
         corpus_log(f"Dumping data to `{self.cache_dir}` ... ")
-        with open(self.checkpoint_path, 'w') as f:
+        if self.writer is None:
+            self.writer = CacheWriter(self.checkpoint_path, format=self.cache_format)
             for data in self.data:
-                json_code = json.dumps(data)
-                f.write(json_code + '\n')
+                self.writer.append(data)
+        self.writer.close()
 
 
     def print_process_info(self):
         total = self.max_instance if self.max_instance != self.inf else '?'
-        corpus_log(f"{self.json_path}:\t{len(self.data)}/{total}", end='\r', flush=True)
+        corpus_log(f"{self.json_path}:\t{self.num_samples}/{total}", end='\r', flush=True)
 
 
     def print_final_info(self):
         total = self.max_instance if self.max_instance != self.inf else '?'
-        corpus_log(console.colorize("green" if len(self.data) == self.max_instance else "red",
-                   f"\033[K{self.json_path}:\t{len(self.data)}/{total}"),
+        corpus_log(console.colorize("green" if self.num_samples == self.max_instance else "red",
+                   f"\033[K{self.json_path}:\t{self.num_samples}/{total}"),
                    flush=True)
 
 
@@ -106,64 +250,182 @@ class BasicCorpus(Dataset, ABC):
 
 
     def __getitem__(self, index):
-        return self.data[index]
+        return convert_sample(self.data[index], self.return_tensors)
+
+
+    def lengths(self):
+        if hasattr(self.data, 'lengths'):
+            return self.data.lengths()
+        return np.array([len(data['input_ids']) for data in self.data], dtype=np.int64)
 
 
 class Corpus(BasicCorpus):
-    def sample_data(self):
-        with open(self.json_path, 'r') as f:
-            line = f.readline()
-        
-            while line:
-                result = None
-                if line.strip():
-                    line = json.loads(line)
-                    result = self.processor.process(line)
+    resumable = True
+
 
+    def __init__(self, *args, num_workers=1, **kwargs):
+        self.num_workers = num_workers
+        super().__init__(*args, **kwargs)
+
+
+    def is_checkpoint_exists(self):
+        # a cache serves any request up to its size, or any request at all
+        # once it reaches the end of the source
+        meta = read_meta(self.checkpoint_path)
+        if meta is None:
+            return False
+        exhausted = meta['complete'] and meta.get('exhausted', False)
+        return meta['num_samples'] >= self.max_instance or exhausted
+
+
+    def load(self):
+        assert self.is_checkpoint_exists(), f"checkpoint not exists"
+        self.data = SampleStore(self.checkpoint_path, max_samples=self.max_instance)
+
+
+    def sample_data(self):
+        if self.num_workers > 1:
+            return self.sample_data_parallel()
+
+        records = self.reader.iter_records(self.resume_offset)
+        remain = lambda: int(min(self.batch_size, self.max_instance - self.num_samples))
+        offset = self.resume_offset
+        while batch := list(islice(records, remain())):
+            offsets, instances = zip(*batch)
+            for result in self.processor.process_batch(list(instances)):
                 if result is not None:
-                    self.data.append(result)
+                    self.append(result)
                     self.print_process_info()
+            offset = offsets[-1]
+            self.checkpoint(offset)
+
+        if self.num_samples < self.max_instance:
+            self.checkpoint(offset, exhausted=True)
+
 
-                if len(self.data) >= self.max_instance:
+    def sample_data_parallel(self):
+        if self.num_samples >= self.max_instance:
+            return
+
+        ranges = self.reader.split_ranges(
+            self.num_workers * CHUNKS_PER_WORKER, 
+            start=self.resume_offset)
+        if ranges is None:
+            return self.sample_data_streaming()
+
+        tasks = [
+            (self.reader, start, end, self.max_instance - self.num_samples, self.batch_size) 
+            for start, end in ranges]
+
+        with multiprocessing.Pool(
+                self.num_workers, 
+                initializer=_init_worker, 
+                initargs=(self.processor,)) as pool:
+
+            # `imap` yields chunks in file order, leaving the pool
+            # terminates the chunks still in flight
+            for (_, end), results in zip(ranges, pool.imap(_process_range, tasks)):
+                for offset, result in results:
+                    self.append(result)
+                    self.print_process_info()
+
+                    if self.num_samples >= self.max_instance:
+                        self.checkpoint(offset)
+                        return
+
+                self.checkpoint(end)
+
+        self.checkpoint(ranges[-1][1] if ranges else self.resume_offset, exhausted=True)
+
+
+    def sample_data_streaming(self):
+        # sources that can not be split are read here, the pool processes
+        # batches with a bounded number of them in flight
+        records = self.reader.iter_records(self.resume_offset)
+        pending = deque()
+        offset = self.resume_offset
+
+        with multiprocessing.Pool(
+                self.num_workers, 
+                initializer=_init_worker, 
+                initargs=(self.processor,)) as pool:
+
+            while True:
+                while len(pending) < self.num_workers * 2 and (batch := list(islice(records, self.batch_size))):
+                    offsets, instances = zip(*batch)
+                    pending.append((offsets, pool.apply_async(_process_batch, (list(instances),))))
+                if not pending:
                     break
 
-                line = f.readline()
+                offsets, results = pending.popleft()
+                for offset, result in zip(offsets, results.get()):
+                    if result is not None:
+                        self.append(result)
+                        self.print_process_info()
+
+                        if self.num_samples >= self.max_instance:
+                            self.checkpoint(offset)
+                            return
+
+                self.checkpoint(offset)
+
+        self.checkpoint(offset, exhausted=True)
 
 
 class RandomSampleCorpus(BasicCorpus):
+    def __init__(self, *args, seed=None, **kwargs):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        super().__init__(*args, **kwargs)
+
+
+    @property
+    def cacheable(self):
+        # without a seed every build draws different lines
+        return self.seed is not None
+
+
+    def cache_key(self):
+        return f"seed={self.seed}"
+
 
     @property
     def total(self):
-        if not hasattr(self, "_total"):
-            count = 0
-            with open(self.json_path, 'r') as f:
-                for _ in f:
-                    count += 1
-            self._total = count
-        return self._total
+        return int(min(self.max_instance, len(self.index)))
 
 
-    def sample_data(self):
-        with open(self.json_path, 'r') as f:
-            line = f.readline()
-            i = 0
-            while line:
-                result = None
-                if line.strip():
-                    line = json.loads(line)
-                    result = self.processor.process(line)
+    def draw_candidates(self, num, tried):
+        n = len(self.index)
+        num = min(num, n - len(tried))
+        if len(tried) * 2 < n:
+            candidates = set()
+            while len(candidates) < num:
+                i = self.rng.randrange(n)
+                if i not in tried:
+                    candidates.add(i)
+            return sorted(candidates)
 
-                if result is not None:
-                    if len(self.data) < self.max_instance:
+        untried = [i for i in range(n) if i not in tried]
+        return sorted(self.rng.sample(untried, num))
+
+
+    def sample_data(self):
+        # pick lines first and only parse and process the chosen ones,
+        # lines rejected by the processor are replaced by fresh candidates
+        self.index = open_index(self.reader)
+        candidates = sorted(reservoir_sample(len(self.index), self.total, self.rng))
+        tried = set(candidates)
+
+        while candidates:
+            for i in range(0, len(candidates), self.batch_size):
+                batch = [self.index[j] for j in candidates[i:i + self.batch_size]]
+                for result in self.processor.process_batch(batch):
+                    if result is not None:
                         self.data.append(result)
-                    else:
-                        j = random.randint(0, i)
-                        if j < self.max_instance:
-                            self.data[j] = result
-                    i += 1
                     self.print_process_info()
 
-                line = f.readline()
+            candidates = self.draw_candidates(self.total - len(self.data), tried)
+            tried.update(candidates)
 
 
     def print_process_info(self):
@@ -195,6 +457,10 @@ class LazyBasicCorpus(BasicCorpus):
         ...
 
 
+    def lengths(self):
+        raise NotImplementedError("lazy corpus does not know sample lengths before processing")
+
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if self.use_cache:
@@ -204,46 +470,135 @@ class LazyBasicCorpus(BasicCorpus):
 
 class LazyCorpus(LazyBasicCorpus):
     def sample_data(self):
-        with open(self.json_path, 'r') as f:
-            for line in f:
-                if line.strip() == '':
-                    continue
-                data = json.loads(line)
-                self.data.append(data)
-                self.print_process_info()
-                if len(self.data) >= self.max_instance:
-                    break
+        # raw instances are read on demand through the line offsets
+        self.data = open_index(self.reader, max_lines=self.max_instance)
 
 
     def __getitem__(self, index):
-        return self.processor.process(self.data[index])
+        return convert_sample(self.processor.process(self.data[index]), self.return_tensors)
 
         
 class LazyRandomSampleCorpus(LazyBasicCorpus):
-    @property
-    def total(self):
-        if not hasattr(self, "_total"):
-            count = 0
-            with open(self.json_path, 'r') as f:
-                for _ in f:
-                    count += 1
-            self._total = count
-        return self._total
+    def __init__(self, *args, seed=0, **kwargs):
+        self.seed = seed
+        super().__init__(*args, **kwargs)
 
 
     def sample_data(self):
-        with open(self.json_path, 'r') as f:
-            for line in f:
-                if line.strip() == '':
-                    continue
-                data = json.loads(line)
-                self.data.append(data)
-        self.data = random.choices(self.data, k=self.max_instance)
+        # Items are lines like in `LazyCorpus`, the draw is made by the sampler:
+        # `DataLoader(corpus, sampler=corpus.sampler)`. It draws anew every
+        # epoch and gives each DDP rank its share.
+        self.data = open_index(self.reader)
+        num_samples = len(self.data) if self.max_instance == self.inf else self.max_instance
+        self.sampler = ResampleSampler(len(self.data), num_samples, seed=self.seed)
 
 
-    def print_process_info(self):
-        corpus_log(f"{self.json_path}:\t{len(self.data)}/{self.total}", end='\r', flush=True)
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
 
 
     def __getitem__(self, index):
-        return self.processor.process(self.data[index])
\ No newline at end of file
+        return convert_sample(self.processor.process(self.data[index]), self.return_tensors)
+
+
+class StreamingCorpus(IterableDataset):
+    def __init__(
+            self,
+            json_path,
+            processor,
+            max_instance=None,
+            shuffle_buffer=0,
+            seed=0,
+            batch_size=256,
+            return_tensors=None,
+            json_backend=None):
+
+        self.json_path = json_path
+        self.processor = processor
+        self.reader = open_reader(json_path, fields=getattr(processor, 'fields', None), backend=json_backend)
+        self.max_instance = max_instance
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.batch_size = batch_size
+        self.return_tensors = return_tensors
+        self.epoch = 0
+
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+    def shard_info(self):
+        return shard_info()
+
+
+    @property
+    def even_shards(self):
+        # DDP ranks must take as many steps or their collectives hang, so
+        # shards are cut to the size of the smallest one; samples dropped by
+        # the processor can still make them differ
+        return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+    def shard_size(self, num_shards):
+        # records in the smallest range shard, None for streams
+        ranges = self.reader.split_ranges(num_shards)
+        if ranges is None:
+            return None
+        if len(ranges) < num_shards:
+            return 0
+        if isinstance(self.reader, ColumnarReader):
+            return min(end - start for start, end in ranges)
+        offsets = load_line_offsets(self.json_path)
+        bounds = np.searchsorted(offsets, np.asarray(ranges, dtype=offsets.dtype))
+        return int((bounds[:, 1] - bounds[:, 0]).min())
+
+
+    def iter_instances(self, shard_id, num_shards):
+        # contiguous ranges of seekable sources, round-robin records of compressed streams
+        even = self.even_shards
+        instances = self.reader.iter_shard(shard_id, num_shards, even=even)
+        if even and (size := self.shard_size(num_shards)) is not None:
+            instances = islice(instances, size)
+        yield from instances
+
+
+    def iter_samples(self, shard_id, num_shards):
+        limit = self.max_instance
+        if limit is not None:
+            limit = limit // num_shards + (not self.even_shards and shard_id < limit % num_shards)
+
+        count = 0
+        instances = self.iter_instances(shard_id, num_shards)
+        while limit is None or count < limit:
+            batch = list(islice(instances, self.batch_size))
+            if len(batch) == 0:
+                break
+
+            for result in self.processor.process_batch(batch):
+                if result is not None:
+                    yield convert_sample(result, self.return_tensors)
+                    count += 1
+                    if limit is not None and count >= limit:
+                        break
+
+
+    def __iter__(self):
+        shard_id, num_shards = self.shard_info()
+        samples = self.iter_samples(shard_id, num_shards)
+        if self.shuffle_buffer <= 1:
+            yield from samples
+            return
+
+        rng = random.Random(hash((self.seed, self.epoch, shard_id)))
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            index = rng.randrange(len(buffer))
+            yield buffer[index]
+            buffer[index] = sample
+
+        rng.shuffle(buffer)
+        yield from buffer
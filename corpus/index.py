@@ -0,0 +1,157 @@
+from .utils import corpus_log, file_fingerprint
+from .reader import JsonlReader, ColumnarReader
+
+import numpy as np
+import os
+
+
+INDEX_SUFFIX = '.idx'
+INDEX_DTYPE = np.uint64
+# magic, source size, number of offsets, source digest
+INDEX_MAGIC = int.from_bytes(b'LINEIDX1', 'little')
+HEADER_SIZE = 4
+BLOCK_SIZE = 1 << 24
+# what `bytes.strip` removes
+WHITESPACE = np.frombuffer(b' \t\n\r\x0b\x0c', dtype=np.uint8)
+
+
+def build_line_offsets(json_path):
+    starts, marks = [], []
+    with open(json_path, 'rb') as f:
+        line_start = 0
+        block_start = 0
+        # non-whitespace bytes seen so far, a line is kept when it adds some
+        seen = 0
+        while block := f.read(BLOCK_SIZE):
+            data = np.frombuffer(block, dtype=np.uint8)
+            solid = np.cumsum(~np.isin(data, WHITESPACE), dtype=np.int64) + seen
+            newlines = np.flatnonzero(data == ord('\n'))
+            ends = newlines.astype(np.int64) + block_start + 1
+            if len(ends):
+                starts.append(np.concatenate([[line_start], ends[:-1]]))
+                marks.append(solid[newlines])
+                line_start = ends[-1]
+            seen = int(solid[-1])
+            block_start += len(block)
+
+        if line_start < block_start:
+            starts.append(np.array([line_start], dtype=np.int64))
+            marks.append(np.array([seen], dtype=np.int64))
+
+    if not starts:
+        return np.empty(0, dtype=INDEX_DTYPE)
+    starts, marks = np.concatenate(starts), np.concatenate(marks)
+    keep = np.diff(marks, prepend=0) > 0
+    return starts[keep].astype(INDEX_DTYPE)
+
+
+def _index_header(json_path, num_offsets):
+    digest = int(file_fingerprint(json_path, mtime=False)[:16], 16)
+    return np.array([INDEX_MAGIC, os.path.getsize(json_path), num_offsets, digest], dtype=INDEX_DTYPE)
+
+
+def _read_index(json_path, index_path):
+    # the offsets of a sidecar index made for the current content of the source, or None
+    if not os.path.exists(index_path) or os.path.getsize(index_path) < HEADER_SIZE * INDEX_DTYPE().itemsize:
+        return None
+    index = np.memmap(index_path, dtype=INDEX_DTYPE, mode='r')
+    magic, size, num_offsets = (int(x) for x in index[:HEADER_SIZE - 1])
+    if magic != INDEX_MAGIC or len(index) != HEADER_SIZE + num_offsets:
+        return None
+    if not np.array_equal(index[:HEADER_SIZE], _index_header(json_path, num_offsets)):
+        return None
+    offsets = index[HEADER_SIZE:]
+    if num_offsets and int(offsets[-1]) >= size:
+        return None
+    return offsets
+
+
+def load_line_offsets(json_path):
+    index_path = json_path + INDEX_SUFFIX
+    if (offsets := _read_index(json_path, index_path)) is not None:
+        return offsets
+
+    corpus_log(f"Building line index for `{json_path}` ... ")
+    offsets = build_line_offsets(json_path)
+    # written aside and moved into place, readers never see a partial index
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        np.concatenate([_index_header(json_path, len(offsets)), offsets]).tofile(tmp_path)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        corpus_log(f"`{index_path}` is not writable, keeping the line index in memory.")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return offsets
+
+
+class LineIndex:
+    def __init__(self, json_path, max_lines=None, reader=None):
+        self.json_path = json_path
+        self.reader = JsonlReader(json_path) if reader is None else reader
+        if not self.reader.seekable:
+            raise ValueError(
+                f"random access to `{json_path}` needs a seekable source, compressed streams "
+                f"are read front to back; decompress it or convert it to parquet or arrow")
+        self.offsets = load_line_offsets(json_path)
+
+        if max_lines is not None:
+            self.offsets = self.offsets[:int(max_lines)]
+        self._file = None
+        self._pid = None
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        return state
+
+
+    @property
+    def file(self):
+        # every (DataLoader worker) process opens its own handle
+        if self._pid != os.getpid():
+            self._file = open(self.json_path, 'rb')
+            self._pid = os.getpid()
+        return self._file
+
+
+    def read_line(self, index):
+        self.file.seek(int(self.offsets[index]))
+        return self.file.readline()
+
+
+    def __getitem__(self, index):
+        return self.reader.loads(self.read_line(index))
+
+
+class RowIndex:
+    # random access to the rows of a columnar source
+    def __init__(self, reader, max_lines=None):
+        self.reader = reader
+        self.num_rows = len(reader)
+        if max_lines is not None:
+            self.num_rows = int(min(self.num_rows, max_lines))
+
+
+    def __len__(self):
+        return self.num_rows
+
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_rows
+        if not 0 <= index < self.num_rows:
+            raise IndexError(index)
+        return self.reader[int(index)]
+
+
+def open_index(reader, max_lines=None):
+    if isinstance(reader, ColumnarReader):
+        return RowIndex(reader, max_lines=max_lines)
+    return LineIndex(reader.path, max_lines=max_lines, reader=reader)
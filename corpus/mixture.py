@@ -0,0 +1,158 @@
+from torch.utils.data import Dataset, IterableDataset
+from .corpus import shard_info
+
+import numpy as np
+
+
+# sources drawn at once by the streaming mixture
+DRAW_BLOCK_SIZE = 4096
+
+
+def _normalize_weights(num_sources, weights):
+    if num_sources == 0:
+        raise ValueError("a mixture needs at least one corpus")
+    weights = np.ones(num_sources) if weights is None else np.asarray(weights, dtype=np.float64)
+    if weights.shape != (num_sources,):
+        raise ValueError(f"got {weights.size} weights for {num_sources} corpora")
+    if (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError("weights must be non-negative and not all zero")
+    return weights / weights.sum()
+
+
+def split_counts(weights, total):
+    # largest remainder, so the counts sum up to `total` exactly
+    quotas = weights * total
+    counts = np.floor(quotas).astype(np.int64)
+    remain = int(total - counts.sum())
+    counts[np.argsort(counts - quotas, kind='stable')[:remain]] += 1
+    return counts
+
+
+class MixtureCorpus(Dataset):
+    """
+    Mixes map-style corpora at the ratios of `weights`, through an index of
+    (source id, sample id) pairs, samples themselves are never copied. A
+    source asked for more samples than it holds has its indices repeated,
+    `num_samples` defaults to the total size of all sources (with weights
+    proportional to the sizes unless given).
+    """
+    def __init__(self, corpora, weights=None, num_samples=None, shuffle=True, seed=0):
+        self.corpora = list(corpora)
+        self.sizes = np.array([len(corpus) for corpus in self.corpora], dtype=np.int64)
+        self.weights = _normalize_weights(len(self.corpora), self.sizes if weights is None else weights)
+        self.num_samples = int(self.sizes.sum() if num_samples is None else num_samples)
+        self.counts = split_counts(self.weights, self.num_samples)
+        if ((self.counts > 0) & (self.sizes == 0)).any():
+            raise ValueError("an empty corpus can not be given a non-zero weight")
+
+        self.shuffle = shuffle
+        self.seed = seed
+        self.set_epoch(0)
+
+
+    def draw(self, epoch):
+        # fully determined by (seed, epoch), sources take their share of whole
+        # passes first and a random subset of their samples for the rest
+        rng = np.random.default_rng((self.seed, epoch))
+        sources, indices = [], []
+        for source, (size, count) in enumerate(zip(self.sizes.tolist(), self.counts.tolist())):
+            if count == 0:
+                continue
+            passes, rest = divmod(count, size)
+            picked = np.concatenate([np.tile(np.arange(size), passes), rng.permutation(size)[:rest]])
+            sources.append(np.full(count, source))
+            indices.append(picked)
+
+        sources = np.concatenate(sources).astype(np.min_scalar_type(len(self.corpora) - 1))
+        indices = np.concatenate(indices).astype(np.min_scalar_type(max(int(self.sizes.max()) - 1, 0)))
+        if self.shuffle:
+            order = rng.permutation(self.num_samples)
+        else:
+            # sources spread evenly, each in its own order
+            ranks = np.concatenate([(np.arange(count) + 0.5) / count for count in self.counts.tolist() if count])
+            order = np.argsort(ranks, kind='stable')
+        return sources[order], indices[order]
+
+
+    def set_epoch(self, epoch):
+        # call before each epoch for a fresh mixture, sub-corpora follow
+        self.sources, self.indices = self.draw(epoch)
+        for corpus in self.corpora:
+            if hasattr(corpus, 'set_epoch'):
+                corpus.set_epoch(epoch)
+
+
+    def __len__(self):
+        return self.num_samples
+
+
+    def __getitem__(self, index):
+        return self.corpora[int(self.sources[index])][int(self.indices[index])]
+
+
+    def lengths(self):
+        lengths = np.empty(self.num_samples, dtype=np.int64)
+        for source, corpus in enumerate(self.corpora):
+            mask = self.sources == source
+            if mask.any():
+                lengths[mask] = np.asarray(corpus.lengths(), dtype=np.int64)[self.indices[mask]]
+        return lengths
+
+
+class StreamingMixtureCorpus(IterableDataset):
+    """
+    Mixes iterable corpora at the ratios of `weights`, each sample comes from
+    a source drawn at random. Sources running out are restarted, the mixture
+    ends once every source has been exhausted at least once, or after
+    `max_instance` samples.
+    """
+    def __init__(self, corpora, weights=None, max_instance=None, seed=0):
+        self.corpora = list(corpora)
+        self.weights = _normalize_weights(len(self.corpora), weights)
+        self.max_instance = max_instance
+        self.seed = seed
+        self.epoch = 0
+
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        for corpus in self.corpora:
+            if hasattr(corpus, 'set_epoch'):
+                corpus.set_epoch(epoch)
+
+
+    def __iter__(self):
+        # sub-corpora shard themselves, the draw differs per shard
+        shard_id, num_shards = shard_info()
+        rng = np.random.default_rng((self.seed, self.epoch, shard_id))
+        limit = self.max_instance
+        if limit is not None:
+            limit = limit // num_shards + (shard_id < limit % num_shards)
+
+        iterators = [iter(corpus) for corpus in self.corpora]
+        weights = self.weights.copy()
+        pending = set(np.flatnonzero(weights).tolist())
+        count = 0
+        while limit is None or count < limit:
+            for source in rng.choice(len(self.corpora), size=DRAW_BLOCK_SIZE, p=weights).tolist():
+                try:
+                    sample = next(iterators[source])
+                except StopIteration:
+                    pending.discard(source)
+                    if not pending:
+                        return
+                    iterators[source] = iter(self.corpora[source])
+                    sample = next(iterators[source], None)
+
+                if sample is None:
+                    # nothing to restart from, e.g. a shard of a small corpus
+                    weights[source] = 0
+                    if weights.sum() == 0:
+                        return
+                    weights /= weights.sum()
+                    break
+
+                yield sample
+                count += 1
+                if limit is not None and count >= limit:
+                    return
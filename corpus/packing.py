@@ -0,0 +1,108 @@
+from torch.utils.data import Dataset
+from .utils import corpus_log
+from .collate import convert_sample
+from .utils import expand_label_spans
+
+import numpy as np
+import bisect
+
+
+def best_fit_decreasing(lengths, capacity):
+    # bins are bucketed by remaining space, `spaces` keeps the non-empty buckets sorted
+    buckets = {}
+    spaces = []
+    bins = []
+
+    for index in np.argsort(-lengths, kind='stable').tolist():
+        length = int(min(lengths[index], capacity))
+        i = bisect.bisect_left(spaces, length)
+
+        if i < len(spaces):
+            space = spaces[i]
+            row = buckets[space].pop()
+            if not buckets[space]:
+                del buckets[space]
+                spaces.pop(i)
+        else:
+            space = capacity
+            row = len(bins)
+            bins.append([])
+
+        bins[row].append(index)
+        space -= length
+        if space > 0:
+            if space not in buckets:
+                buckets[space] = []
+                bisect.insort(spaces, space)
+            buckets[space].append(row)
+
+    return bins
+
+
+class PackedCorpus(Dataset):
+    def __init__(self, corpus, pad_length):
+        processor = corpus.processor
+        if processor.pad_length is not None:
+            raise ValueError("packing needs unpadded samples, build the corpus with `pad_length=None`.")
+
+        self.corpus = corpus
+        self.pad_length = pad_length
+        self.pad_side = processor.pad_side
+        self.pad_token_id = processor.tokenizer.pad_token_id
+
+        lengths = corpus.lengths()
+        if (num_truncated := int((lengths > pad_length).sum())) > 0:
+            corpus_log(f"{num_truncated} samples are longer than {pad_length} tokens and will be truncated.")
+
+        self.rows = best_fit_decreasing(lengths, pad_length)
+        corpus_log(f"packed {len(lengths)} samples into {len(self.rows)} rows, "
+                   f"{lengths.clip(max=pad_length).sum() / max(len(self.rows) * pad_length, 1):.2%} filled.")
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def __getitem__(self, index):
+        input_ids, labels, position_ids = [], [], []
+        cu_seqlens = [0]
+
+        for sample_index in self.rows[index]:
+            sample = convert_sample(self.corpus[sample_index])
+            length = min(len(sample['input_ids']), self.pad_length)
+            sample_labels = (
+                sample['labels'][:length] 
+                if 'labels' in sample 
+                else expand_label_spans(sample['input_ids'], sample['label_spans'])[:length].tolist())
+
+            # the first token of a document must not be predicted from the previous one
+            if length > 0:
+                sample_labels[0] = -100
+
+            input_ids += list(sample['input_ids'][:length])
+            labels += sample_labels
+            position_ids += range(length)
+            cu_seqlens.append(cu_seqlens[-1] + length)
+
+        remain = self.pad_length - len(input_ids)
+        attention_mask = [0] * len(input_ids)
+        if self.pad_side == 'left':
+            shift = remain
+            input_ids = [self.pad_token_id] * remain + input_ids
+            labels = [-100] * remain + labels
+            position_ids = [0] * remain + position_ids
+            attention_mask = [1] * remain + attention_mask
+        elif self.pad_side == 'right':
+            shift = 0
+            input_ids = input_ids + [self.pad_token_id] * remain
+            labels = labels + [-100] * remain
+            position_ids = position_ids + [0] * remain
+            attention_mask = attention_mask + [1] * remain
+        else: raise NotImplementedError
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "attention_mask": attention_mask,
+            "position_ids": position_ids,
+            "cu_seqlens": [shift + x for x in cu_seqlens]}
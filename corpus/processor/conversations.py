@@ -10,7 +10,7 @@ import dataclasses
 from enum import auto, IntEnum
 from io import BytesIO
 import os
-from typing import List, Any, Dict, Union, Tuple
+from typing import List, Any, Callable, Dict, Union, Tuple
 
 
 class SeparatorStyle(IntEnum):
@@ -44,6 +44,351 @@ class SeparatorStyle(IntEnum):
 IMAGE_PLACEHOLDER_STR = "$$<image>$$"
 
 
+def _with_images(message):
+    if type(message) is tuple:
+        message, images = message
+        message = IMAGE_PLACEHOLDER_STR * len(images) + message
+    return message
+
+
+def _drop_images(message):
+    if type(message) is tuple:
+        message, images = message
+    return message
+
+
+@dataclasses.dataclass
+class TemplateRenderer:
+    """A prompt renderer specialized to one separator style.
+
+    A prompt is `prefix` followed by one `(head, content, tail)` triple per
+    message, where `content` is the (possibly transformed) message and `head`
+    and `tail` are the role header and separator around it. An empty message
+    renders as its head only, which opens a turn for generation.
+    """
+
+    # (system_prompt, system_message) -> prefix
+    prefix: Callable[[str, str], str]
+    # (index, role, message) -> (head, content, tail)
+    turn: Callable[[int, str, Any], Tuple[str, str, str]]
+    # messages -> messages actually rendered
+    select: Callable[[List], List] = None
+    # prompt -> final prompt
+    finalize: Callable[[str], str] = None
+
+    def split(self, system_prompt: str, system_message: str, messages: List):
+        """Get the prefix and the (head, content, tail) triple of every turn."""
+        if self.select is not None:
+            messages = self.select(messages)
+        turn = self.turn
+        return self.prefix(system_prompt, system_message), [
+            turn(i, role, message) for i, (role, message) in enumerate(messages)
+        ]
+
+    def render(self, system_prompt: str, system_message: str, messages: List) -> str:
+        """Render the prompt with a single join."""
+        prefix, turns = self.split(system_prompt, system_message, messages)
+        parts = [prefix]
+        for head, content, tail in turns:
+            parts.append(head)
+            parts.append(content)
+            parts.append(tail)
+        ret = "".join(parts)
+        return ret if self.finalize is None else self.finalize(ret)
+
+    def pieces(self, system_prompt: str, system_message: str, messages: List):
+        """Split the prompt into non-empty (text, role, is_content) pieces.
+
+        Role headers and the prefix belong to no role, a message and the
+        separator closing it belong to the message's role. `finalize` is
+        applied to the joined prompt, the pieces are cut where it changes the
+        prompt and what it adds closes the last piece kept, so joining the
+        pieces always matches `render`.
+        """
+        prefix, turns = self.split(system_prompt, system_message, messages)
+        if self.select is not None:
+            messages = self.select(messages)
+
+        pieces = [(prefix, None, False)]
+        for (role, _), (head, content, tail) in zip(messages, turns):
+            pieces.append((head, None, False))
+            pieces.append((content, role, True))
+            pieces.append((tail, role, False))
+        pieces = [piece for piece in pieces if piece[0]]
+        if self.finalize is None:
+            return pieces
+
+        text = "".join(piece[0] for piece in pieces)
+        final = self.finalize(text)
+        keep = len(os.path.commonprefix([text, final]))
+
+        result, pos = [], 0
+        for piece_text, role, is_content in pieces:
+            if pos >= keep:
+                break
+            result.append((piece_text[:keep - pos], role, is_content))
+            pos += len(piece_text)
+
+        rest = final[keep:]
+        if rest:
+            if result and not result[-1][2]:
+                last_text, role, _ = result.pop()
+                result.append((last_text + rest, role, False))
+            else:
+                result.append((rest, result[-1][1] if result else None, False))
+        return result
+
+
+def compile_renderer(
+    sep_style: SeparatorStyle,
+    name: str,
+    roles: Tuple[str],
+    sep: str,
+    sep2: str,
+) -> TemplateRenderer:
+    """Build the renderer of one separator style, mirroring the classic prompt layout."""
+    seps = [sep, sep2]
+
+    if sep_style == SeparatorStyle.ADD_COLON_SINGLE:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp + sep,
+            turn=lambda i, role, message: (role + ": ", message, sep)
+            if message
+            else (role + ":", "", ""),
+        )
+    elif sep_style == SeparatorStyle.ADD_COLON_TWO:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp + sep,
+            turn=lambda i, role, message: (
+                role + ": ",
+                _with_images(message),
+                seps[i % 2],
+            )
+            if message
+            else (role + ":", "", ""),
+        )
+    elif sep_style == SeparatorStyle.ADD_COLON_SPACE_SINGLE:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp + sep,
+            # must be end with a space
+            turn=lambda i, role, message: (role + ": ", message, sep)
+            if message
+            else (role + ": ", "", ""),
+        )
+    elif sep_style == SeparatorStyle.ADD_NEW_LINE_SINGLE:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: "" if sp == "" else sp + sep,
+            turn=lambda i, role, message: (role + "\n", message, sep)
+            if message
+            else (role + "\n", "", ""),
+        )
+    elif sep_style == SeparatorStyle.NO_COLON_SINGLE:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp,
+            turn=lambda i, role, message: (role, message, sep)
+            if message
+            else (role, "", ""),
+        )
+    elif sep_style == SeparatorStyle.NO_COLON_TWO:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp,
+            turn=lambda i, role, message: (role, message, seps[i % 2])
+            if message
+            else (role, "", ""),
+        )
+    elif sep_style == SeparatorStyle.RWKV:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp,
+            turn=lambda i, role, message: (
+                role + ": ",
+                message.replace("\r\n", "\n").replace("\n\n", "\n"),
+                "\n\n",
+            )
+            if message
+            else (role + ":", "", ""),
+        )
+    elif sep_style == SeparatorStyle.LLAMA2:
+
+        def turn(i, role, message):
+            tag = roles[i % 2]
+            if not message:
+                return tag, "", ""
+            if i == 0:
+                return "", message, " "
+            return tag + " ", message, seps[i % 2]
+
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp if sm else "[INST] ",
+            turn=turn,
+        )
+    elif sep_style == SeparatorStyle.LLAMA3:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: "<|begin_of_text|>" + (sp if sm else ""),
+            turn=lambda i, role, message: (
+                f"<|start_header_id|>{role}<|end_header_id|>\n\n",
+                message.strip(),
+                "<|eot_id|>",
+            )
+            if message
+            else (f"<|start_header_id|>{role}<|end_header_id|>\n\n", "", ""),
+        )
+    elif sep_style == SeparatorStyle.CHATGLM:
+        # source: https://huggingface.co/THUDM/chatglm-6b/blob/1d240ba371910e9282298d4592532d7f0f3e9f3e/modeling_chatglm.py#L1302-L1308
+        # source2: https://huggingface.co/THUDM/chatglm2-6b/blob/e186c891cf64310ac66ef10a87e6635fa6c2a579/modeling_chatglm.py#L926
+        round_add_n = 1 if name == "chatglm2" else 0
+
+        def turn(i, role, message):
+            head = f"[Round {i//2 + round_add_n}]{sep}" if i % 2 == 0 else ""
+            if message:
+                return f"{head}{role}：", message, sep
+            return f"{head}{role}：", "", ""
+
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp + sep if sp else "",
+            turn=turn,
+        )
+    elif sep_style == SeparatorStyle.CHATML:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: "" if sp == "" else sp + sep + "\n",
+            turn=lambda i, role, message: (
+                role + "\n",
+                _with_images(message),
+                sep + "\n",
+            )
+            if message
+            else (role + "\n", "", ""),
+        )
+    elif sep_style == SeparatorStyle.CHATGLM3:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp if sm else "",
+            turn=lambda i, role, message: (role + "\n", message, "")
+            if message
+            else (role, "", ""),
+        )
+    elif sep_style == SeparatorStyle.CHATINTERN:
+        # source: https://huggingface.co/internlm/internlm-chat-7b-8k/blob/bd546fa984b4b0b86958f56bf37f94aa75ab8831/modeling_internlm.py#L771
+        def turn(i, role, message):
+            head = ("<s>" if i % 2 == 0 else "") + role + ":"
+            if message:
+                return head, message, seps[i % 2] + "\n"
+            return head, "", ""
+
+        return TemplateRenderer(prefix=lambda sp, sm: sp, turn=turn)
+    elif sep_style == SeparatorStyle.DOLLY:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp,
+            turn=lambda i, role, message: (
+                role + ":\n",
+                message,
+                seps[i % 2] + ("\n\n" if i % 2 == 1 else ""),
+            )
+            if message
+            else (role + ":\n", "", ""),
+        )
+    elif sep_style == SeparatorStyle.PHOENIX:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp,
+            turn=lambda i, role, message: (role + ": " + "<s>", message, "</s>")
+            if message
+            else (role + ": " + "<s>", "", ""),
+        )
+    elif sep_style == SeparatorStyle.ROBIN:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp + sep,
+            turn=lambda i, role, message: (role + ":\n", message, sep)
+            if message
+            else (role + ":\n", "", ""),
+        )
+    elif sep_style == SeparatorStyle.FALCON_CHAT:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp + sep if sm else "",
+            turn=lambda i, role, message: (role + ": ", message, sep)
+            if message
+            else (role + ":", "", ""),
+        )
+    elif sep_style == SeparatorStyle.METAMATH:
+        # For MetaMath, sep2 is used to prefix the message.
+        def turn(i, role, message):
+            starting_sep = ":\n" if i % 2 == 0 else ": " + sep2
+            ending_sep = sep if i % 2 == 0 else ""
+            if message:
+                return role + starting_sep, message, ending_sep
+            return role + starting_sep, "", ""
+
+        return TemplateRenderer(
+            prefix=lambda sp, sm: "" if sp == "" else sp + sep,
+            turn=turn,
+        )
+    elif sep_style == SeparatorStyle.DEEPSEEK_CHAT:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp,
+            turn=lambda i, role, message: (role + ": ", message, seps[i % 2])
+            if message
+            else (role + ":", "", ""),
+        )
+    elif sep_style == SeparatorStyle.YUAN2:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp + seps[1] if sm else "",
+            turn=lambda i, role, message: ("", message, "<n>")
+            if message
+            else ("", "", ""),
+            finalize=lambda ret: ret.rstrip("<n>") + seps[0],
+        )
+    elif sep_style == SeparatorStyle.GEMMA:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: "<bos>",
+            turn=lambda i, role, message: (
+                "<start_of_turn>" + role + "\n",
+                message,
+                sep,
+            )
+            if message
+            else ("<start_of_turn>" + role + "\n", "", ""),
+        )
+    elif sep_style == SeparatorStyle.CLLM:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp + sep,
+            turn=lambda i, role, message: (
+                role + ": ",
+                _with_images(message),
+                seps[i % 2],
+            )
+            if message
+            else (role + ":", "", ""),
+            select=lambda messages: messages[-2:],
+        )
+    elif sep_style == SeparatorStyle.DEFAULT:
+        return TemplateRenderer(
+            prefix=lambda sp, sm: sp + "\n",
+            turn=lambda i, role, message: (role + ": ", _drop_images(message), "\n")
+            if message
+            else (role + ":", "", ""),
+        )
+    else:
+        raise ValueError(f"Invalid style: {sep_style}")
+
+
+# Compiled renderers, keyed by everything a renderer depends on
+_renderers: Dict[Tuple, TemplateRenderer] = {}
+
+
+def get_renderer(
+    sep_style: SeparatorStyle,
+    name: str,
+    roles: Tuple[str],
+    sep: str,
+    sep2: str,
+) -> TemplateRenderer:
+    """Get the compiled renderer of a template, compiling it on first use."""
+    key = (sep_style, name, tuple(roles), sep, sep2)
+    renderer = _renderers.get(key)
+    if renderer is None:
+        renderer = _renderers[key] = compile_renderer(
+            sep_style, name, roles, sep, sep2
+        )
+    return renderer
+
+
 @dataclasses.dataclass
 class Conversation:
     """A class that manages prompt templates and keeps all conversation history."""
@@ -72,256 +417,21 @@ class Conversation:
     # The maximum image size in megabytes that this model takes in. None means we do not resize the image.
     max_image_size_mb: int = None
 
-    def get_prompt(self) -> str:
-        """Get the prompt for generation."""
-        system_prompt = self.system_template.format(system_message=self.system_message)
-        if self.sep_style == SeparatorStyle.ADD_COLON_SINGLE:
-            ret = system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + message + self.sep
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.ADD_COLON_TWO:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt + seps[0]
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
-                    ret += role + ": " + message + seps[i % 2]
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.ADD_COLON_SPACE_SINGLE:
-            ret = system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + message + self.sep
-                else:
-                    ret += role + ": "  # must be end with a space
-            return ret
-        elif self.sep_style == SeparatorStyle.ADD_NEW_LINE_SINGLE:
-            ret = "" if system_prompt == "" else system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + "\n" + message + self.sep
-                else:
-                    ret += role + "\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.NO_COLON_SINGLE:
-            ret = system_prompt
-            for role, message in self.messages:
-                if message:
-                    ret += role + message + self.sep
-                else:
-                    ret += role
-            return ret
-        elif self.sep_style == SeparatorStyle.NO_COLON_TWO:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += role + message + seps[i % 2]
-                else:
-                    ret += role
-            return ret
-        elif self.sep_style == SeparatorStyle.RWKV:
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += (
-                        role
-                        + ": "
-                        + message.replace("\r\n", "\n").replace("\n\n", "\n")
-                    )
-                    ret += "\n\n"
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.LLAMA2:
-            seps = [self.sep, self.sep2]
-            if self.system_message:
-                ret = system_prompt
-            else:
-                ret = "[INST] "
-            for i, (role, message) in enumerate(self.messages):
-                tag = self.roles[i % 2]
-                if message:
-                    if i == 0:
-                        ret += message + " "
-                    else:
-                        ret += tag + " " + message + seps[i % 2]
-                else:
-                    ret += tag
-            return ret
-        elif self.sep_style == SeparatorStyle.LLAMA3:
-            ret = "<|begin_of_text|>"
-            if self.system_message:
-                ret += system_prompt
-            else:
-                ret += ""
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += f"<|start_header_id|>{role}<|end_header_id|>\n\n"
-                    ret += f"{message.strip()}<|eot_id|>"
-                else:
-                    ret += f"<|start_header_id|>{role}<|end_header_id|>\n\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.CHATGLM:
-            # source: https://huggingface.co/THUDM/chatglm-6b/blob/1d240ba371910e9282298d4592532d7f0f3e9f3e/modeling_chatglm.py#L1302-L1308
-            # source2: https://huggingface.co/THUDM/chatglm2-6b/blob/e186c891cf64310ac66ef10a87e6635fa6c2a579/modeling_chatglm.py#L926
-            round_add_n = 1 if self.name == "chatglm2" else 0
-            if system_prompt:
-                ret = system_prompt + self.sep
-            else:
-                ret = ""
+    def get_renderer(self) -> TemplateRenderer:
+        """Get the compiled renderer of this template."""
+        return get_renderer(
+            self.sep_style, self.name, self.roles, self.sep, self.sep2
+        )
 
-            for i, (role, message) in enumerate(self.messages):
-                if i % 2 == 0:
-                    ret += f"[Round {i//2 + round_add_n}]{self.sep}"
+    def get_system_prompt(self) -> str:
+        """Get the formatted system prompt."""
+        return self.system_template.format(system_message=self.system_message)
 
-                if message:
-                    ret += f"{role}：{message}{self.sep}"
-                else:
-                    ret += f"{role}："
-            return ret
-        elif self.sep_style == SeparatorStyle.CHATML:
-            ret = "" if system_prompt == "" else system_prompt + self.sep + "\n"
-            for role, message in self.messages:
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
-                    ret += role + "\n" + message + self.sep + "\n"
-                else:
-                    ret += role + "\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.CHATGLM3:
-            ret = ""
-            if self.system_message:
-                ret += system_prompt
-            for role, message in self.messages:
-                if message:
-                    ret += role + "\n" + message
-                else:
-                    ret += role
-            return ret
-        elif self.sep_style == SeparatorStyle.CHATINTERN:
-            # source: https://huggingface.co/internlm/internlm-chat-7b-8k/blob/bd546fa984b4b0b86958f56bf37f94aa75ab8831/modeling_internlm.py#L771
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if i % 2 == 0:
-                    ret += "<s>"
-                if message:
-                    ret += role + ":" + message + seps[i % 2] + "\n"
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.DOLLY:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += role + ":\n" + message + seps[i % 2]
-                    if i % 2 == 1:
-                        ret += "\n\n"
-                else:
-                    ret += role + ":\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.PHOENIX:
-            ret = system_prompt
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + "<s>" + message + "</s>"
-                else:
-                    ret += role + ": " + "<s>"
-            return ret
-        elif self.sep_style == SeparatorStyle.ROBIN:
-            ret = system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ":\n" + message + self.sep
-                else:
-                    ret += role + ":\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.FALCON_CHAT:
-            ret = ""
-            if self.system_message:
-                ret += system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + message + self.sep
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.METAMATH:
-            ret = "" if system_prompt == "" else system_prompt + self.sep
-            for i, (role, message) in enumerate(self.messages):
-                # For MetaMath, sep2 is used to prefix the message.
-                starting_sep = ":\n" if i % 2 == 0 else ": " + self.sep2
-                ending_sep = self.sep if i % 2 == 0 else ""
-                if message:
-                    ret += role + starting_sep + message + ending_sep
-                else:
-                    ret += role + starting_sep
-            return ret
-        elif self.sep_style == SeparatorStyle.DEEPSEEK_CHAT:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += role + ": " + message + seps[i % 2]
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.YUAN2:
-            seps = [self.sep, self.sep2]
-            ret = ""
-            if self.system_message:
-                ret += system_prompt + seps[1]
-            for _, message in self.messages:
-                if message:
-                    ret += message + "<n>"
-                else:
-                    ret += ""
-            ret = ret.rstrip("<n>") + seps[0]
-            return ret
-        elif self.sep_style == SeparatorStyle.GEMMA:
-            ret = "<bos>"
-            for role, message in self.messages:
-                if message:
-                    ret += "<start_of_turn>" + role + "\n" + message + self.sep
-                else:
-                    ret += "<start_of_turn>" + role + "\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.CLLM:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt + seps[0]
-            for i, (role, message) in enumerate(self.messages[-2:]):
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
-                    ret += role + ": " + message + seps[i % 2]
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.DEFAULT:
-            ret = system_prompt + "\n"
-            for role, message in self.messages:
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                    ret += role + ": " + message + "\n"
-                else:
-                    ret += role + ":"
-            return ret
-        else:
-            raise ValueError(f"Invalid style: {self.sep_style}")
+    def get_prompt(self) -> str:
+        """Get the prompt for generation."""
+        return self.get_renderer().render(
+            self.get_system_prompt(), self.system_message, self.messages
+        )
 
     def get_images(self):
         images = []
@@ -706,6 +816,24 @@ def get_conv_template(name: str) -> Conversation:
     return conv_templates[name].copy()
 
 
+def render_many(
+    name: str, conversations: List[List], system_message: str = None
+) -> List[str]:
+    """Render many message lists with a registered template.
+
+    Each conversation is a list of (role, message) pairs. The template is
+    neither copied nor mutated, and its system prompt is formatted once.
+    """
+    template = conv_templates[name]
+    if system_message is None:
+        system_message = template.system_message
+    system_prompt = template.system_template.format(system_message=system_message)
+    render = template.get_renderer().render
+    return [
+        render(system_prompt, system_message, messages) for messages in conversations
+    ]
+
+
 # An empty template for raw conversation.
 register_conv_template(
     Conversation(
@@ -1,17 +1,42 @@
+from ..utils import encode_label_spans
+
 from abc import ABC, abstractmethod
 from typing import Union, List
+import hashlib
+import json
+
+
+def tokenizer_fingerprint(tokenizer):
+    digest = hashlib.sha256(tokenizer.__class__.__name__.encode())
+
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        # fast tokenizers serialize vocab, merges, normalizer and added tokens
+        digest.update(backend.to_str().encode())
+    else:
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+
+    special_tokens = {
+        "map": tokenizer.special_tokens_map,
+        "ids": tokenizer.all_special_ids,
+        "pad_token_id": tokenizer.pad_token_id}
+    digest.update(json.dumps(special_tokens, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
 
 
 class BasicProcessor(ABC):
-    def __init__(self, path, tokenizer, pad_side='left', pad_length=None):
+    def __init__(self, path, tokenizer, pad_side='left', pad_length=None, label_spans=False):
         self.path = path
         self.tokenizer = tokenizer
         self.pad_side = pad_side
         self.pad_length = pad_length
+        self.label_spans = label_spans
         self.config = self.create_config()
 
         with open(path, 'r') as f:
-            self.signature = f"{f.read()}/{tokenizer.__class__.__name__}/{pad_side}/{pad_length}"
+            self.signature = f"{f.read()}/{tokenizer_fingerprint(tokenizer)}/{pad_side}/{pad_length}"
+        if label_spans:
+            self.signature += "/label_spans"
 
 
     @abstractmethod
@@ -19,11 +44,21 @@ class BasicProcessor(ABC):
         pass
 
 
+    @property
+    def fields(self):
+        # keys of the raw instance read by `process`, None for all of them
+        return None
+
+
     @abstractmethod
     def process(self, instance: dict) -> Union[List, List, List]:
         pass
 
 
+    def process_batch(self, instances: List[dict]) -> List:
+        return [self.process(instance) for instance in instances]
+
+
     def padding(self, input_ids, labels, attention_mask):        
         if self.pad_length is not None:
             remain = self.pad_length - len(input_ids)
@@ -41,3 +76,21 @@ class BasicProcessor(ABC):
             else: raise NotImplementedError
 
         return input_ids, labels, attention_mask
+
+
+    def make_sample(self, input_ids, labels, attention_mask):
+        input_ids, labels, attention_mask = self.padding(
+            input_ids, labels, attention_mask)
+
+        # trainable (start, end) runs instead of a dense label list,
+        # expanded back by the collator
+        if self.label_spans:
+            return {
+                "input_ids": input_ids,
+                "label_spans": encode_label_spans(input_ids, labels),
+                "attention_mask": attention_mask}
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "attention_mask": attention_mask}
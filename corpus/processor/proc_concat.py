@@ -1,6 +1,5 @@
 from dataclasses import dataclass
 from collections import OrderedDict
-import copy
 from typing import Optional, List, Dict
 import json
 from .proc_base import BasicProcessor
@@ -29,6 +28,11 @@ from .proc_base import BasicProcessor
 """
 
 
+# initial characters per token guess, and tokens dropped at a chunk cut
+CHARS_PER_TOKEN = 4
+TRUNC_MARGIN = 16
+
+
 @dataclass
 class Keyword:
     trunc_rear: bool
@@ -61,29 +65,92 @@ class ConcatProcessor(BasicProcessor):
             truncation=truncation_config)
 
 
+    @property
+    def fields(self):
+        return list(self.config.concat.keys())
+
+
     def process(self, instance):
+        return self.process_batch([instance])[0]
+
+
+    def process_batch(self, instances):
+        if len(instances) == 0:
+            return []
+
+        texts = OrderedDict((key, []) for key in self.config.concat.keys())
+        for instance in instances:
+            for key, concat in self.config.concat.items():
+
+                if key not in instance.keys():
+                    raise ValueError
+
+                # text level truncation
+                text = instance[key]
+                if concat.trunc_txt is not None:
+                    text = (
+                        text[:concat.trunc_txt * 1024] 
+                        if concat.trunc_rear 
+                        else text[-concat.trunc_txt * 1024:])
+                texts[key].append(text)
+
+        # convert to tokens, one tokenizer call per field and round
+        tokens = {
+            key: self.tokenize(text, self.token_budget(key), self.config.concat[key].trunc_rear)
+            for key, text in texts.items()}
+
+        return [
+            self.assemble({key: tokens[key][i] for key in texts.keys()})
+            for i in range(len(instances))]
+
+
+    def token_budget(self, key):
+        # a field pruned by the final truncation never keeps more than
+        # `max_tokens` tokens, other fields are kept whole
+        truncation = self.config.truncation
+        if truncation.enable and key in (truncation.order or []):
+            return truncation.max_tokens
+        return None
+
+
+    def tokenize(self, texts, budget=None, trunc_rear=True):
+        # Tokenize chunks growing from the kept end of each text until they
+        # yield `budget` tokens, plus a margin at the cut whose tokens may
+        # differ from the tokenization of the whole text.
+        if budget is None:
+            return self.tokenizer(texts, add_special_tokens=False).input_ids
+
+        result = [None] * len(texts)
+        pending = list(range(len(texts)))
+        num_chars = (budget + TRUNC_MARGIN) * CHARS_PER_TOKEN
+        while pending:
+            chunks = [
+                texts[i][:num_chars] if trunc_rear else texts[i][-num_chars:]
+                for i in pending]
+            encodings = self.tokenizer(chunks, add_special_tokens=False)
+
+            remain = []
+            for i, chunk, input_ids in zip(pending, chunks, encodings.input_ids):
+                if len(chunk) == len(texts[i]):
+                    result[i] = input_ids
+                elif len(input_ids) >= budget + TRUNC_MARGIN:
+                    result[i] = input_ids[:budget] if trunc_rear else input_ids[len(input_ids) - budget:]
+                else:
+                    remain.append(i)
+
+            pending = remain
+            num_chars *= 2
+
+        return result
+
+
+    def assemble(self, tokens):
         result = OrderedDict()
         num_tokens = 0
 
-        for key in self.config.concat.keys():
-
-            if key not in instance.keys():
-                raise ValueError
-
+        for key, input_ids in tokens.items():
             concat = self.config.concat[key]
-
-            # text level truncation
-            text = instance[key]
-            if concat.trunc_txt is not None:
-                text = (
-                    text[:concat.trunc_txt * 1024] 
-                    if concat.trunc_rear 
-                    else text[-concat.trunc_txt * 1024:])
-            
-            # convert to tokens
-            input_ids = self.tokenizer(text, add_special_tokens=False).input_ids
-
-            labels = copy.deepcopy(input_ids) if concat.train else [-100] * len(input_ids)
+            labels = input_ids if concat.train else [-100] * len(input_ids)
             result[key] = {
                 "input_ids": input_ids,
                 "labels": labels,
@@ -100,7 +167,8 @@ class ConcatProcessor(BasicProcessor):
 
                     if num_prune == len(result[key]['input_ids']):
                         result[key]['input_ids'] = []
-                        result[key]['input_ids'] = []
+                        result[key]['labels'] = []
+                        exceed -= num_prune
                         continue
 
                     if result[key]['trunc_rear']:
@@ -122,11 +190,4 @@ class ConcatProcessor(BasicProcessor):
         attention_mask = [0] * len(input_ids)
 
         # padding
-        input_ids, labels, attention_mask = self.padding(
-            input_ids, labels, attention_mask)
-
-        return {
-            "input_ids": input_ids,
-            "labels": labels,
-            "attention_mask": attention_mask
-        }
+        return self.make_sample(input_ids, labels, attention_mask)
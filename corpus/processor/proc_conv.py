@@ -1,11 +1,11 @@
-from .conversations import get_conv_template, SeparatorStyle
+from .conversations import conv_templates
 from .proc_base import BasicProcessor
 from ..utils import corpus_log
 
 from dataclasses import dataclass, field
 from typing import List, Dict
+import numpy as np
 import json
-import copy
 
 
 """
@@ -19,7 +19,8 @@ import copy
         "roles": {
             "user": 0,      # 0 不可训练
             "assistant": 1  # 1 可训练
-        }
+        },
+        "check_tokenization": true
     },
     "truncation": {
         "enable": false,
@@ -29,6 +30,23 @@ import copy
 """
 
 
+# prepended to every piece before tokenization, see `ConversationProcessor.tokenize`
+ANCHOR = "\n"
+
+# samples checked in every batch after the first, which is checked whole
+CHECK_SAMPLES = 8
+
+# messages of the conversations checked by `check_tokenization`
+PROBE_MESSAGES = [
+    "Hello! Can you help me with something?",
+    "Of course. What do you need?",
+    "What is 12 + 30? Explain it step by step.\n",
+    " The answer is 42:\n1. take 12\n2. add 30 ",
+    "def double(x):\n    return x * 2",
+    "好的，谢谢你的帮助。",
+]
+
+
 @dataclass
 class ConversationConfig:
     conv_template: str = field(default=None)
@@ -36,6 +54,7 @@ class ConversationConfig:
     role_keyword: str = field(default=None)
     cont_keyword: str = field(default=None)
     roles: Dict[str, int] = field(default=None) 
+    check_tokenization: bool = field(default=True)
 
 
 @dataclass
@@ -61,7 +80,8 @@ class ConversationProcessor(BasicProcessor):
             conv_keyword=config["conversation"]["conv_keyword"],
             role_keyword=config["conversation"]["role_keyword"],
             cont_keyword=config["conversation"]["cont_keyword"],
-            roles=roles)
+            roles=roles,
+            check_tokenization=config["conversation"].get("check_tokenization", True))
         truncation = TruncationConfig(
             enable=config["truncation"]["enable"],
             max_tokens=config["truncation"]["max_tokens"])
@@ -70,85 +90,206 @@ class ConversationProcessor(BasicProcessor):
             conversation=conversation,
             truncation=truncation)
 
+        # special tokens the tokenizer adds around a sequence, e.g. bos / eos
+        probe = self.tokenizer("a", add_special_tokens=False).input_ids
+        full = self.tokenizer("a").input_ids
+        start = next(
+            (i for i in range(len(full) - len(probe) + 1) if full[i:i + len(probe)] == probe),
+            len(full))
+        self.special_ids = (full[:start], full[start + len(probe):])
+
+        self.anchor_ids = self.tokenizer(ANCHOR, add_special_tokens=False).input_ids
+
+        # token ids of the template prefix, role headers and separators
+        self.constant_ids = {}
+
+        # Whole prompts are tokenized once the tokenizer is seen merging tokens
+        # across pieces, on probe conversations here and on real samples later.
+        self.whole_prompt = False
+        self.checked_batch = False
+        if conversation.check_tokenization:
+            template = conv_templates[conversation.conv_template]
+            samples = [
+                self.pieces(template, [(template.roles[i % 2], PROBE_MESSAGES[i]) for i in range(n)])
+                for n in range(1, len(PROBE_MESSAGES) + 1)]
+            if not self.matches(samples, self.assemble_batch(samples, template.roles[1])):
+                self.use_whole_prompt(conversation.conv_template)
+
         return config
     
 
+    @property
+    def fields(self):
+        return [self.config.conversation.conv_keyword]
+
+
     def process(self, instance):
+        return self.process_batch([instance])[0]
+
+
+    def process_batch(self, instances):
+        if len(instances) == 0:
+            return []
+
+        # The registered template is shared, never copied or mutated.
+        template = conv_templates[self.config.conversation.conv_template]
+        samples = [self.pieces(template, self.render(template, instance)) for instance in instances]
+
+        if not self.whole_prompt:
+            assembled = self.assemble_batch(samples, template.roles[1])
+            if self.config.conversation.check_tokenization:
+                # the first batch of every process is checked whole, later ones in part
+                num_checked = CHECK_SAMPLES if self.checked_batch else len(samples)
+                self.checked_batch = True
+                if not self.matches(samples[:num_checked], assembled[:num_checked]):
+                    self.use_whole_prompt(self.config.conversation.conv_template)
+            if not self.whole_prompt:
+                return [self.finish(*sample) for sample in assembled]
+
+        encodings = self.tokenizer(
+            ["".join(text for text, _, _ in pieces) for pieces in samples],
+            add_special_tokens=False,
+            return_offsets_mapping=True)
+        return [
+            self.finish(*self.mask(pieces, input_ids, offsets, template.roles[1]))
+            for pieces, input_ids, offsets in zip(samples, encodings.input_ids, encodings.offset_mapping)]
+
+
+    def pieces(self, template, messages):
+        renderer = template.get_renderer()
+        return self.split(renderer.pieces(template.get_system_prompt(), template.system_message, messages))
+
+
+    def assemble_batch(self, samples, trainable_role):
+        # Only message contents are tokenized, one tokenizer call per batch.
+        # The prefix, role headers and separators are tokenized once and cached,
+        # keyed by whether they lead the prompt.
+        contents = [
+            (text, i == 0) for pieces in samples
+            for i, (text, _, is_content) in enumerate(pieces) if is_content]
+        content_ids = iter(self.tokenize(contents))
+        self.cache_constants(
+            (text, i == 0) for pieces in samples
+            for i, (text, _, is_content) in enumerate(pieces) if not is_content)
+        return [self.assemble(pieces, content_ids, trainable_role) for pieces in samples]
+
+
+    def matches(self, samples, assembled):
+        # whether assembled piece ids equal the tokenization of the whole prompts
+        if len(samples) == 0:
+            return True
+        prefix_ids, suffix_ids = self.special_ids
+        prompts = ["".join(text for text, _, _ in pieces) for pieces in samples]
+        return all(
+            prefix_ids + input_ids + suffix_ids == expected
+            for (input_ids, _), expected in zip(assembled, self.tokenizer(prompts).input_ids))
+
+
+    def use_whole_prompt(self, conv_template):
+        self.whole_prompt = True
+        corpus_log(f"the tokenizer merges tokens across the pieces of `{conv_template}` "
+                   f"prompts, tokenizing whole prompts instead.")
+
+
+    def render(self, template, instance):
         conv_keyword = self.config.conversation.conv_keyword
         role_keyword = self.config.conversation.role_keyword
         cont_keyword = self.config.conversation.cont_keyword
-        conv = get_conv_template(self.config.conversation.conv_template)
         source = instance[conv_keyword]
         
         roles = {}
         for role, id in self.config.conversation.roles.items():
-            roles.update({role: conv.roles[id]})
+            roles.update({role: template.roles[id]})
 
-        if roles[source[0][role_keyword]] != conv.roles[0]:
-            instance = instance[1:]
+        if roles[source[0][role_keyword]] != template.roles[0]:
+            source = source[1:]
 
-        conv.messages = []
+        messages = []
         for j, sentence in enumerate(source):
             role = roles[sentence[role_keyword]]
-            assert role == conv.roles[j % 2]
-            conv.append_message(role, sentence[cont_keyword])
-        conversation = conv.get_prompt()
-
-        # Tokenize conversations
-        input_ids = self.tokenizer(
-            conversation,
-            max_length=self.config.truncation.max_tokens,
-            truncation=self.config.truncation.enable,
-        ).input_ids
-        target = copy.deepcopy(input_ids)
-
-        assert conv.sep_style == SeparatorStyle.ADD_COLON_TWO
-
-        # Mask targets. Only compute loss on the assistant outputs.
-        sep = conv.sep + conv.roles[1] + ": "
-        total_len = len(target)
-
-        turns = conversation.split(conv.sep2)
-        cur_len = 1
-        target[:cur_len] = [-100] * len(target[:cur_len])
-        for i, turn in enumerate(turns):
-            if turn == "":
-                break
-            turn_len = len(self.tokenizer(turn).input_ids)
-
-            parts = turn.split(sep)
-            if len(parts) != 2:
-                break
-            parts[0] += sep
-            # "-2" is hardcoded for the Llama tokenizer to make the offset correct.
-            instruction_len = len(self.tokenizer(parts[0]).input_ids) - 2
-
-            # if i != 0 and not self.tokenizer.legacy:
-            #     # The legacy and non-legacy modes handle special tokens differently
-            #     instruction_len -= 1
-
-            # Ignore the user instructions
-            target[cur_len : cur_len + instruction_len] = [-100] * len(target[cur_len : cur_len + instruction_len])
-            cur_len += turn_len
-
-            # if i != 0 and not self.tokenizer.legacy:
-            #     # The legacy and non-legacy modes handle special tokens differently
-            #     cur_len -= 1
-
-        target[cur_len:] = [-100] * len(target[cur_len:])
-
-        if cur_len < self.tokenizer.model_max_length:
-            if cur_len != total_len:
-                target = [-100] * len(target)
-                corpus_log(
-                    f"WARNING: tokenization mismatch: {cur_len} vs. {total_len}."
-                    f" #turn = {len(turns) - 1}. (ignored)")
-
-        attention_mask = [0] * len(input_ids)                
-        input_ids, target, attention_mask = self.padding(
-            input_ids, target, attention_mask)
-
-        return dict(
-            input_ids=input_ids,
-            labels=target,
-            attention_mask=attention_mask)
\ No newline at end of file
+            assert role == template.roles[j % 2]
+            messages.append((role, sentence[cont_keyword]))
+        return messages
+
+
+    def split(self, pieces):
+        # Move a space ending a piece into the next piece, so that word-initial
+        # tokens come out as in the tokenization of the whole prompt.
+        result = []
+        for text, role, is_content in pieces:
+            if result and result[-1][0].endswith(' ') and not text[0].isspace():
+                last, last_role, last_is_content = result.pop()
+                if len(last) > 1:
+                    result.append((last[:-1], last_role, last_is_content))
+                text = ' ' + text
+            result.append((text, role, is_content))
+        return result
+
+
+    def cache_constants(self, pieces):
+        missing = list(dict.fromkeys(piece for piece in pieces if piece not in self.constant_ids))
+        self.constant_ids.update(zip(missing, self.tokenize(missing)))
+
+
+    def tokenize(self, pieces):
+        # Tokenize (text, leading) pieces as they appear in the prompt. Pieces
+        # after the first one go behind an anchor that is stripped again, so
+        # tokenizers prepending a prefix space (sentencepiece) don't add one to
+        # every piece. Pieces merging with the anchor fall back to plain
+        # tokenization.
+        if len(pieces) == 0:
+            return []
+
+        anchor = self.anchor_ids
+        encodings = self.tokenizer(
+            [text if leading else ANCHOR + text for text, leading in pieces],
+            add_special_tokens=False)
+
+        result = []
+        for (text, leading), input_ids in zip(pieces, encodings.input_ids):
+            if leading:
+                result.append(input_ids)
+            elif input_ids[:len(anchor)] == anchor:
+                result.append(input_ids[len(anchor):])
+            else:
+                result.append(self.tokenizer(text, add_special_tokens=False).input_ids)
+        return result
+
+
+    def assemble(self, pieces, content_ids, trainable_role):
+        # Only compute loss on the assistant outputs and the separators closing them.
+        input_ids, labels = [], []
+        for i, (text, role, is_content) in enumerate(pieces):
+            ids = next(content_ids) if is_content else self.constant_ids[text, i == 0]
+            input_ids += ids
+            labels += ids if role == trainable_role else [-100] * len(ids)
+        return input_ids, labels
+
+
+    def mask(self, pieces, input_ids, offsets, trainable_role):
+        # Labels of a whole-prompt tokenization: a token is trained when its
+        # last character comes from a trainable piece.
+        trainable = np.concatenate([
+            np.full(len(text), role == trainable_role) for text, role, _ in pieces] or [np.zeros(0, bool)])
+        offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
+        starts, ends = offsets[:, 0], offsets[:, 1]
+        keep = (ends > starts) & trainable[np.maximum(ends - 1, 0)]
+        labels = np.where(keep, np.array(input_ids, dtype=np.int64), -100).tolist()
+        return list(input_ids), labels
+
+
+    def finish(self, input_ids, labels):
+        prefix_ids, suffix_ids = self.special_ids
+        input_ids = list(prefix_ids) + input_ids
+        labels = [-100] * len(prefix_ids) + labels
+
+        if self.config.truncation.enable:
+            max_tokens = self.config.truncation.max_tokens - len(suffix_ids)
+            input_ids = input_ids[:max_tokens]
+            labels = labels[:max_tokens]
+
+        input_ids += suffix_ids
+        labels += [-100] * len(suffix_ids)
+
+        attention_mask = [0] * len(input_ids)
+        return self.make_sample(input_ids, labels, attention_mask)
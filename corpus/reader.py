@@ -0,0 +1,470 @@
+from .utils import split_byte_ranges
+
+from threading import Thread, Event
+from queue import Queue, Empty
+from collections import OrderedDict
+import bisect
+import json
+import gzip
+import bz2
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+"""
+Sources are read by extension:
+
+    .gz .bz2 .zst .zstd     compressed jsonl, streamed
+    .parquet                parquet, read by record batches
+    .arrow .feather .ipc    arrow ipc, file or stream format, memory-mapped
+    anything else           plain jsonl
+
+Records come with their position in the source, used to resume builds and
+to split the source between workers: the byte offset right after the line
+for jsonl (of the decompressed stream when compressed), the row index
+right after the record for columnar sources. Compressed jsonl can not be
+indexed for random access (lazy and random-sample corpora).
+"""
+
+
+READ_BLOCK_SIZE = 1 << 22
+RECORD_BATCH_SIZE = 1024
+QUEUE_BLOCKS = 8
+ROW_GROUP_CACHE = 4
+BACKENDS = ('orjson', 'simdjson', 'json')
+COMPRESSIONS = {'.gz': 'gzip', '.bz2': 'bzip2', '.zst': 'zstd', '.zstd': 'zstd'}
+PARQUET_SUFFIXES = ('.parquet',)
+ARROW_SUFFIXES = ('.arrow', '.feather', '.ipc')
+
+
+def _compression(path):
+    return COMPRESSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def _open_compressed(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'bzip2':
+        return bz2.open(path, 'rb')
+    if zstandard is None:
+        raise ImportError(f"reading `{path}` requires `zstandard`, install `corpus[fast]`")
+    # allow frames written in long distance mode
+    decompressor = zstandard.ZstdDecompressor(max_window_size=1 << 31)
+    return decompressor.stream_reader(open(path, 'rb'), read_size=READ_BLOCK_SIZE, closefd=True)
+
+
+def _iter_blocks(f, block_size):
+    while block := f.read(block_size):
+        yield block
+
+
+def _read_ahead(blocks, depth=QUEUE_BLOCKS):
+    # produce blocks on a background thread, decompressors release the GIL,
+    # so decompression overlaps with parsing and processing
+    queue = Queue(depth)
+    stop = Event()
+    done = object()
+
+    def produce():
+        try:
+            for block in blocks:
+                if stop.is_set():
+                    return
+                queue.put(block)
+            queue.put(done)
+        except BaseException as e:
+            queue.put(e)
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while (block := queue.get()) is not done:
+            if isinstance(block, BaseException):
+                raise block
+            yield block
+    finally:
+        # unblock the producer before the source gets closed
+        stop.set()
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+
+def iter_blocks(path, start=0, block_size=READ_BLOCK_SIZE):
+    # decompressed blocks of a jsonl source from byte `start` on
+    compression = _compression(path)
+    if compression is None:
+        with open(path, 'rb', buffering=0) as f:
+            f.seek(start)
+            yield from _iter_blocks(f, block_size)
+        return
+
+    with _open_compressed(path, compression) as f:
+        blocks = _read_ahead(_iter_blocks(f, block_size))
+        try:
+            # streams can not seek, skip to `start` by decompressing
+            for block in blocks:
+                if start >= len(block):
+                    start -= len(block)
+                    continue
+                yield block[start:]
+                break
+            yield from blocks
+        finally:
+            blocks.close()
+
+
+def read_lines(path, start=0, end=None, block_size=READ_BLOCK_SIZE):
+    # yields (offset right after the line, line without its newline) for the
+    # lines starting before `end`, read in large blocks
+    pos = start
+    rest = b''
+    for block in iter_blocks(path, start, block_size):
+        lines = (rest + block).split(b'\n') if rest else block.split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            if end is not None and pos >= end:
+                return
+            pos += len(line) + 1
+            yield pos, line
+
+    if rest and (end is None or pos < end):
+        yield pos + len(rest), rest
+
+
+def iter_lines(path, start=0, end=None):
+    for _, line in read_lines(path, start, end):
+        yield line
+
+
+def get_backend(backend=None, fields=None):
+    if backend is None:
+        # orjson decodes whole records, simdjson only converts the projected fields
+        preferred = ('simdjson', 'orjson') if fields is not None else ('orjson', 'simdjson')
+        installed = {'orjson': orjson is not None, 'simdjson': simdjson is not None}
+        return next((name for name in preferred if installed[name]), 'json')
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown json backend `{backend}`, expected one of {BACKENDS}")
+    if (backend == 'orjson' and orjson is None) or (backend == 'simdjson' and simdjson is None):
+        raise ImportError(f"json backend `{backend}` is not installed, install `corpus[fast]`")
+    return backend
+
+
+def _to_python(value):
+    if isinstance(value, simdjson.Object):
+        return value.as_dict()
+    if isinstance(value, simdjson.Array):
+        return value.as_list()
+    return value
+
+
+class JsonlReader:
+    """
+    Reads the records of a jsonl file. With `fields`, records only keep these
+    keys. Only the simdjson backend skips converting the other keys to python
+    objects, orjson and json decode whole records first, so simdjson is the
+    default when `fields` is given and installed.
+    """
+    def __init__(self, path, fields=None, backend=None):
+        self.path = path
+        self.fields = None if fields is None else list(fields)
+        self.backend = get_backend(backend, self.fields)
+        # compressed streams can only be read front to back
+        self.seekable = _compression(path) is None
+        self._parser = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_parser'] = None
+        return state
+
+
+    def split_ranges(self, num_ranges, start=0):
+        if not self.seekable:
+            return None
+        return split_byte_ranges(self.path, num_ranges, start=start)
+
+
+    def project(self, instance):
+        if self.fields is None:
+            return instance
+        return {key: instance[key] for key in self.fields if key in instance}
+
+
+    def loads(self, line):
+        if self.backend == 'simdjson':
+            if self._parser is None:
+                self._parser = simdjson.Parser()
+            try:
+                document = self._parser.parse(line)
+            except ValueError:
+                return self.project(json.loads(line))
+            if self.fields is None:
+                return _to_python(document)
+            return {key: _to_python(document[key]) for key in self.fields if key in document}
+
+        if self.backend == 'orjson':
+            try:
+                return self.project(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                # e.g. integers beyond 64 bit, the stdlib decides
+                pass
+        return self.project(json.loads(line))
+
+
+    def iter_records(self, start=0, end=None):
+        # yields (offset right after the line, instance), skipping blank lines
+        for offset, line in read_lines(self.path, start, end):
+            if line.strip():
+                yield offset, self.loads(line)
+
+
+    def iter_shard(self, shard_id, num_shards, even=False):
+        ranges = self.split_ranges(num_shards)
+        if ranges is None:
+            # streams can not seek, records are dealt round-robin and only the
+            # shard's own records are parsed; `even` holds each one back until
+            # its round is complete, so that all shards get as many
+            held = None
+            records = (line for line in iter_lines(self.path) if line.strip())
+            for i, line in enumerate(records):
+                if i % num_shards == shard_id:
+                    if not even:
+                        yield self.loads(line)
+                    held = line
+                if even and i % num_shards == num_shards - 1 and held is not None:
+                    yield self.loads(held)
+                    held = None
+            return
+
+        # every shard reads its own byte range only, ranges are evened by
+        # the caller that knows their sizes
+        if shard_id < len(ranges):
+            for _, instance in self.iter_records(*ranges[shard_id]):
+                yield instance
+
+
+    def __iter__(self):
+        for _, instance in self.iter_records():
+            yield instance
+
+
+class ColumnarReader:
+    """
+    Reads the rows of a parquet or arrow ipc file as dicts, batch by batch.
+    With `fields`, only these columns are read.
+    """
+    seekable = True
+
+
+    def __init__(self, path, fields=None, backend=None):
+        if pa is None:
+            raise ImportError(f"reading `{path}` requires `pyarrow`, install `corpus[arrow]`")
+        self.path = path
+        self.fields = None if fields is None else list(fields)
+        self._table = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_table'] = None
+        return state
+
+
+    def columns(self, schema):
+        if self.fields is None:
+            return None
+        return [name for name in self.fields if name in schema.names]
+
+
+    def __len__(self):
+        return self.table.num_rows
+
+
+    @property
+    def table(self):
+        # arrow ipc is memory-mapped, its pages are shared by workers and
+        # read on demand, parquet is decoded whole
+        if self._table is None:
+            self._table = self.read_table()
+        return self._table
+
+
+    def split_ranges(self, num_ranges, start=0):
+        bounds = sorted({start + (len(self) - start) * i // num_ranges for i in range(num_ranges + 1)})
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+    def iter_batches(self, start=0, end=None):
+        # yields (row index of the first row, record batch)
+        end = len(self) if end is None else min(end, len(self))
+        if start >= end:
+            return
+        offset = start
+        for batch in self.table.slice(start, end - start).to_batches(RECORD_BATCH_SIZE):
+            yield offset, batch
+            offset += batch.num_rows
+
+
+    def iter_records(self, start=0, end=None):
+        # yields (row index right after the record, instance)
+        for offset, batch in self.iter_batches(start, end):
+            for i, instance in enumerate(batch.to_pylist(), start=offset + 1):
+                yield i, instance
+
+
+    def iter_shard(self, shard_id, num_shards, even=False):
+        # every shard reads its own range of rows only, ranges are evened by
+        # the caller that knows their sizes
+        ranges = self.split_ranges(num_shards)
+        if shard_id < len(ranges):
+            for _, batch in self.iter_batches(*ranges[shard_id]):
+                yield from batch.to_pylist()
+
+
+    def __getitem__(self, index):
+        return self.table.slice(index, 1).to_pylist()[0]
+
+
+    def __iter__(self):
+        for _, instance in self.iter_records():
+            yield instance
+
+
+class ParquetReader(ColumnarReader):
+    def __init__(self, path, fields=None, backend=None):
+        super().__init__(path, fields=fields, backend=backend)
+        self._file = None
+        self._pid = None
+        self._bounds = None
+        self._row_groups = OrderedDict()
+
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_file'] = None
+        state['_pid'] = None
+        state['_row_groups'] = OrderedDict()
+        return state
+
+
+    def read_table(self):
+        schema = pq.read_schema(self.path)
+        return pq.read_table(self.path, columns=self.columns(schema), memory_map=True)
+
+
+    @property
+    def file(self):
+        # every (DataLoader worker) process opens its own handle
+        if self._pid != os.getpid():
+            self._file = pq.ParquetFile(self.path, memory_map=True)
+            self._pid = os.getpid()
+            self._row_groups = OrderedDict()
+        return self._file
+
+
+    @property
+    def bounds(self):
+        # first row of every row group, and the number of rows last
+        if self._bounds is None:
+            metadata = self.file.metadata
+            self._bounds = [0]
+            for i in range(metadata.num_row_groups):
+                self._bounds.append(self._bounds[-1] + metadata.row_group(i).num_rows)
+        return self._bounds
+
+
+    def row_group(self, i):
+        # random access decodes single row groups, the last few are kept
+        if i in self._row_groups:
+            self._row_groups.move_to_end(i)
+            return self._row_groups[i]
+        group = self.file.read_row_group(i, columns=self.columns(self.file.schema_arrow))
+        self._row_groups[i] = group
+        if len(self._row_groups) > ROW_GROUP_CACHE:
+            self._row_groups.popitem(last=False)
+        return group
+
+
+    def __getitem__(self, index):
+        if self._table is not None:
+            return super().__getitem__(index)
+        i = bisect.bisect_right(self.bounds, index) - 1
+        return self.row_group(i).slice(index - self.bounds[i], 1).to_pylist()[0]
+
+
+    def __len__(self):
+        return self.bounds[-1]
+
+
+    def iter_batches(self, start=0, end=None):
+        # read front to back by row group, without loading the whole table
+        if self._table is not None:
+            yield from super().iter_batches(start, end)
+            return
+
+        f = pq.ParquetFile(self.path, memory_map=True)
+        bounds = self.bounds
+        end = bounds[-1] if end is None else min(end, bounds[-1])
+
+        first = bisect.bisect_right(bounds, start) - 1
+        last = bisect.bisect_left(bounds, end)
+        if start >= end or first >= last:
+            return
+
+        offset = bounds[first]
+        for batch in f.iter_batches(
+                batch_size=RECORD_BATCH_SIZE,
+                row_groups=list(range(first, last)),
+                columns=self.columns(f.schema_arrow)):
+            lo, hi = max(start - offset, 0), min(end - offset, batch.num_rows)
+            if lo < hi:
+                yield offset + lo, batch.slice(lo, hi - lo)
+            offset += batch.num_rows
+            if offset >= end:
+                return
+
+
+class ArrowReader(ColumnarReader):
+    def read_table(self):
+        source = pa.memory_map(self.path, 'r')
+        try:
+            table = pa.ipc.open_file(source).read_all()
+        except pa.ArrowInvalid:
+            # the stream format, e.g. written by huggingface datasets
+            source.seek(0)
+            table = pa.ipc.open_stream(source).read_all()
+        columns = self.columns(table.schema)
+        return table if columns is None else table.select(columns)
+
+
+def open_reader(path, fields=None, backend=None):
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix in PARQUET_SUFFIXES:
+        return ParquetReader(path, fields=fields)
+    if suffix in ARROW_SUFFIXES:
+        return ArrowReader(path, fields=fields)
+    return JsonlReader(path, fields=fields, backend=backend)
@@ -0,0 +1,115 @@
+from torch.utils.data import Sampler
+import torch.distributed as dist
+import numpy as np
+import math
+
+
+class ResampleSampler(Sampler):
+    # every rank iterates its own share of the same draw, like `DistributedSampler`
+    def __init__(self, num_lines, num_samples, seed=0, num_replicas=None, rank=None):
+        distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank {rank} is not in [0, {num_replicas})")
+
+        self.num_lines = num_lines
+        self.num_samples = int(num_samples)
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_local = math.ceil(self.num_samples / num_replicas)
+
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+    def draw(self, epoch):
+        # with replacement, fully determined by (seed, epoch)
+        rng = np.random.default_rng((self.seed, epoch))
+        return rng.integers(0, self.num_lines, size=self.num_samples, dtype=np.int64)
+
+
+    def __len__(self):
+        return self.num_local
+
+
+    def __iter__(self):
+        # padded by wrapping around, so ranks get as many indices each
+        indices = np.resize(self.draw(self.epoch), self.num_local * self.num_replicas)
+        # fresh draw next time even if `set_epoch` is never called
+        self.epoch += 1
+        return iter(indices[self.rank::self.num_replicas].tolist())
+
+
+class LengthGroupedBatchSampler(Sampler):
+    def __init__(
+            self,
+            corpus,
+            max_tokens,
+            max_batch_size=None,
+            group_size=8192,
+            shuffle=True,
+            seed=0):
+
+        # padded batch size is `len(batch) * max(lengths)`, which must fit `max_tokens`
+        self.lengths = np.asarray(corpus.lengths() if hasattr(corpus, 'lengths') else corpus, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.group_size = group_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+
+    def make_batches(self, epoch):
+        rng = np.random.default_rng((self.seed, epoch))
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(order), self.group_size):
+            # sort inside a group of random samples, longest first
+            group = order[start:start + self.group_size]
+            group = group[np.argsort(-self.lengths[group], kind='stable')]
+
+            batch, batch_len = [], 0
+            for index, length in zip(group.tolist(), self.lengths[group].tolist()):
+                full = (
+                    (len(batch) + 1) * max(batch_len, length) > self.max_tokens or 
+                    (self.max_batch_size is not None and len(batch) >= self.max_batch_size))
+                if batch and full:
+                    batches.append(batch)
+                    batch, batch_len = [], 0
+                batch.append(index)
+                batch_len = max(batch_len, length)
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self.make_batches(self.epoch)
+        return len(self._batches)
+
+
+    def __iter__(self):
+        if self._batches is None:
+            self._batches = self.make_batches(self.epoch)
+        batches, self._batches = self._batches, None
+        # fresh batches next time even if `set_epoch` is never called
+        self.epoch += 1
+        return iter(batches)
@@ -1,87 +1,393 @@
-import json
 import numpy as np
 from .utils import corpus_log
+from .reader import open_reader
 from .corpus import BasicCorpus
+from .cache import SampleArrays, SampleStore
 
+from collections import Counter
+import multiprocessing
+import math
 
 
-def stat_corpus(corpus):
-    length = {}
-    num_instance = 0
-    keywords = corpus.data[0]
-    for key in keywords:
-        length[key] = []
+"""
+Statistics are kept in mergeable states of bounded size: running aggregates,
+a histogram of lengths over power-of-two bins and a relative-error quantile
+sketch per field, so a file can be summarized by several processes over
+separate ranges and the partial states merged.
+"""
 
-    for data in corpus.data:
-        num_instance += 1
-        for key, value in data.items():
-            if isinstance(value, (str, list)):
-                length[key].append(len(value))
-            elif isinstance(value, (int, float)):
-                length[key].append(value)
 
+CHUNKS_PER_WORKER = 4
+BUFFER_SIZE = 4096
+NUM_BINS = 65
+PERCENTILES = (50, 90, 99)
 
-    corpus_log(f"num_instance: {num_instance}")
-    for keyword, value in keywords.items():
-        corpus_log("-" * 40)
-        corpus_log(f"{keyword}:")
-        corpus_log(f"\ttype: {type(value)}")
-        
-        if isinstance(value, (str, list)):
-            corpus_log(f"\tmax_length: {max(length[keyword])}")
-            corpus_log(f"\tmin_length: {min(length[keyword])}")
-            corpus_log(f"\tavg_length: {np.mean(length[keyword])}")
+
+class QuantileSketch:
+    # DDSketch: values fall into logarithmic buckets, any quantile is
+    # answered within `relative_accuracy` of the true value
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.positive = Counter()
+        self.negative = Counter()
+        self.zeros = 0
+        self.count = 0
+
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.count += len(values)
+        self.zeros += int(np.count_nonzero(values == 0))
+        for store, part in ((self.positive, values[values > 0]), (self.negative, -values[values < 0])):
+            if len(part):
+                keys, counts = np.unique(np.ceil(np.log(part) / self.log_gamma).astype(np.int64), return_counts=True)
+                store.update(dict(zip(keys.tolist(), counts.tolist())))
+
+
+    def merge(self, other):
+        assert self.relative_accuracy == other.relative_accuracy
+        self.positive.update(other.positive)
+        self.negative.update(other.negative)
+        self.zeros += other.zeros
+        self.count += other.count
+
+
+    def value(self, key):
+        return 2 * math.exp(key * self.log_gamma) / (1 + math.exp(self.log_gamma))
+
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self.value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self.value(key)
+        return self.value(max(self.positive))
+
+
+class Aggregate:
+    def __init__(self, histogram=False):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch()
+        # bin 0 holds zeros, bin i holds [2 ** (i - 1), 2 ** i)
+        self.histogram = np.zeros(NUM_BINS, dtype=np.int64) if histogram else None
+
+
+    def add(self, values):
+        values = np.asarray(values)
+        if len(values) == 0:
+            return
+
+        self.count += len(values)
+        self.total += float(values.sum())
+        low, high = values.min().item(), values.max().item()
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.sketch.add(values)
+
+        if self.histogram is not None:
+            bins = np.zeros(len(values), dtype=np.int64)
+            positive = values > 0
+            bins[positive] = np.floor(np.log2(values[positive])).astype(np.int64) + 1
+            self.histogram += np.bincount(np.minimum(bins, NUM_BINS - 1), minlength=NUM_BINS)
+
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for name, pick in (('min', min), ('max', max)):
+            mine, theirs = getattr(self, name), getattr(other, name)
+            setattr(self, name, theirs if mine is None else mine if theirs is None else pick(mine, theirs))
+        self.sketch.merge(other.sketch)
+        if self.histogram is not None:
+            self.histogram += other.histogram
+
+
+    def summary(self):
+        result = {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else None}
+        for p in PERCENTILES:
+            # sketch values are bucket midpoints, which may lie outside the data
+            value = self.sketch.quantile(p / 100)
+            result[f"p{p}"] = None if value is None else min(max(value, self.min), self.max)
+
+        if self.histogram is not None:
+            used = np.flatnonzero(self.histogram).tolist()
+            result["histogram"] = [
+                (0 if i == 0 else 2 ** (i - 1), 0 if i == 0 else 2 ** i - 1, int(self.histogram[i]))
+                for i in used]
+        return result
+
+
+class FieldStats:
+    def __init__(self):
+        self.types = Counter()
+        self.lengths = Aggregate(histogram=True)
+        self.values = Aggregate()
+        self.pending = {'lengths': [], 'values': []}
+
+
+    def add(self, value):
+        self.types[type(value).__name__] += 1
+        if isinstance(value, (str, list, np.ndarray)):
+            self.pending['lengths'].append(len(value))
         elif isinstance(value, (int, float)):
-            corpus_log(f"\tmax: {max(length[keyword])}")
-            corpus_log(f"\tmin: {min(length[keyword])}")
-            corpus_log(f"\tavg: {np.mean(length[keyword])}")
+            self.pending['values'].append(value)
+
+        if len(self.pending['lengths']) + len(self.pending['values']) >= BUFFER_SIZE:
+            self.flush()
+
+
+    def add_lengths(self, lengths, type_name):
+        self.types[type_name] += len(lengths)
+        self.lengths.add(lengths)
+
+
+    def flush(self):
+        for name, pending in self.pending.items():
+            if pending:
+                getattr(self, name).add(pending)
+                self.pending[name] = []
+
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.types.update(other.types)
+        self.lengths.merge(other.lengths)
+        self.values.merge(other.values)
+
 
+    def summary(self, num_instance):
+        self.flush()
+        count = sum(self.types.values())
+        result = {
+            "types": dict(self.types),
+            "count": count,
+            "missing": num_instance - count}
+        if self.lengths.count:
+            result["length"] = self.lengths.summary()
+        if self.values.count:
+            result["value"] = self.values.summary()
+        return result
 
 
-def stat_json_file(path):
+class StatState:
+    # mergeable statistics of a stream of records, keys may vary between records
+    def __init__(self):
+        self.num_instance = 0
+        self.fields = {}
 
-    length = {}
-    num_instance = 0
 
-    with open(path, 'r') as f:
-        line = f.readline()
-        keywords = json.loads(line)
+    def field(self, key):
+        if key not in self.fields:
+            self.fields[key] = FieldStats()
+        return self.fields[key]
 
-        for key in keywords:
-            length[key] = []
 
-        while line:
-            if line.strip():
-                num_instance += 1
-                line = json.loads(line)
-                for key, value in line.items():
-                    if isinstance(value, (str, list)):
-                        length[key].append(len(value))
-                    elif isinstance(value, (int, float)):
-                        length[key].append(value)
+    def add(self, instance):
+        self.num_instance += 1
+        for key, value in instance.items():
+            self.field(key).add(value)
 
-            line = f.readline()
 
-    corpus_log(f"num_instance: {num_instance}")
-    for keyword, value in keywords.items():
+    def merge(self, other):
+        self.num_instance += other.num_instance
+        for key, field in other.fields.items():
+            self.field(key).merge(field)
+        return self
+
+
+    def result(self):
+        return {
+            "num_instance": self.num_instance,
+            "fields": {key: field.summary(self.num_instance) for key, field in self.fields.items()}}
+
+
+def log_result(result):
+    corpus_log(f"num_instance: {result['num_instance']}")
+    for key, field in result['fields'].items():
         corpus_log("-" * 40)
-        corpus_log(f"{keyword}:")
-        corpus_log(f"\ttype: {type(value)}")
-        
-        if isinstance(value, (str, list)):
-            corpus_log(f"\tmax_length: {max(length[keyword])}")
-            corpus_log(f"\tmin_length: {min(length[keyword])}")
-            corpus_log(f"\tavg_length: {np.mean(length[keyword])}")
-        elif isinstance(value, (int, float)):
-            corpus_log(f"\tmax: {max(length[keyword])}")
-            corpus_log(f"\tmin: {min(length[keyword])}")
-            corpus_log(f"\tavg: {np.mean(length[keyword])}")
+        corpus_log(f"{key}:")
+        corpus_log(f"\ttype: {', '.join(field['types'])}")
+        if field['missing']:
+            corpus_log(f"\tmissing: {field['missing']}")
+
+        for name, label in (('length', '_length'), ('value', '')):
+            if name not in field:
+                continue
+            summary = field[name]
+            corpus_log(f"\tmax{label}: {summary['max']}")
+            corpus_log(f"\tmin{label}: {summary['min']}")
+            corpus_log(f"\tavg{label}: {summary['mean']}")
+            percentiles = ', '.join(f"p{p}={summary[f'p{p}']:.6g}" for p in PERCENTILES)
+            corpus_log(f"\tpercentiles{label}: {percentiles}")
+
+
+def stat_corpus(corpus, verbose=True):
+    state = StatState()
+    data = corpus.data
+
+    if hasattr(data, 'lengths') and len(data) > 0:
+        # token buffers are summarized column by column, from their offsets
+        state.num_instance = len(data)
+        for key, value in data[0].items():
+            state.field(key).add_lengths(data.lengths(key), type(value).__name__)
+    else:
+        for sample in data:
+            state.add(sample)
+
+    result = state.result()
+    if verbose:
+        log_result(result)
+    return result
+
+
+def _stat_range(args):
+    reader, start, end = args
+    state = StatState()
+    for _, instance in reader.iter_records(start, end):
+        state.add(instance)
+    for field in state.fields.values():
+        field.flush()
+    return state
+
+
+def stat_json_file(path, num_workers=1, json_backend=None, verbose=True):
+    reader = open_reader(path, backend=json_backend)
+    ranges = reader.split_ranges(num_workers * CHUNKS_PER_WORKER) if num_workers > 1 else None
+
+    if ranges is None:
+        state = _stat_range((reader, 0, None))
+    else:
+        state = StatState()
+        with multiprocessing.Pool(num_workers) as pool:
+            for partial in pool.imap_unordered(_stat_range, [(reader, start, end) for start, end in ranges]):
+                state.merge(partial)
+
+    result = state.result()
+    if verbose:
+        log_result(result)
+    return result
+
+
+def _iter_arrays(data):
+    # flat buffers of a built corpus, segment by segment
+    if isinstance(data, SampleStore):
+        remain = len(data)
+        for segment in data.segments:
+            if remain <= 0:
+                return
+            yield segment, min(len(segment), remain)
+            remain -= len(segment)
+    elif isinstance(data, SampleArrays):
+        yield data, len(data)
+    else:
+        raise ValueError("the token efficiency needs a built corpus, lazy corpora hold raw instances")
+
+
+def _sample_sums(values, offsets):
+    # per-sample sums of a flat buffer, from prefix sums at the offsets
+    prefix = np.concatenate([[0], np.cumsum(values, dtype=np.int64)])
+    return prefix[offsets[1:].astype(np.int64)] - prefix[offsets[:-1].astype(np.int64)]
+
+
+def _trainable_tokens(arrays):
+    if 'label_spans' in arrays.buffers:
+        # spans of a sample are (start, end) pairs, so pairs never straddle two samples
+        spans = np.asarray(arrays.buffers['label_spans'], dtype=np.int64)
+        return _sample_sums(spans[1::2] - spans[::2], arrays.offsets['label_spans'] // 2)
+    return _sample_sums(arrays.buffers['labels'] != -100, arrays.offsets['labels'])
+
+
+def log_efficiency(result):
+    corpus_log(f"num_instance: {result['num_instance']}")
+    corpus_log(f"num_tokens: {result['num_tokens']}")
+    corpus_log(f"padding: {result['padding_tokens']} ({result['padding_fraction']:.2%}), "
+               f"pad_length={result['pad_length']}, pad_side={result['pad_side']}")
+    if result['max_tokens'] is not None:
+        corpus_log(f"truncated: {result['truncated']} ({result['truncated_fraction']:.2%}), "
+                   f"max_tokens={result['max_tokens']}")
+    corpus_log(f"trainable: {result['trainable_tokens']} "
+               f"({result['trainable_ratio']:.2%} of content, {result['trainable_fraction']:.2%} of all tokens)")
+    corpus_log(f"fully masked: {result['fully_masked']} ({result['fully_masked_fraction']:.2%})")
+
+
+def stat_efficiency(corpus, verbose=True):
+    """
+    What a built corpus costs in tokens: the padding, the samples cut at the
+    truncation limit, and the tokens carrying a label. Computed on the flat
+    buffers of the cache, padding is where `attention_mask` is 1.
+    """
+    processor = corpus.processor
+    truncation = getattr(processor.config, 'truncation', None)
+    max_tokens = truncation.max_tokens if truncation is not None and truncation.enable else None
+
+    num_instance = num_tokens = padding_tokens = 0
+    truncated = trainable_tokens = fully_masked = 0
+    for arrays, num_samples in _iter_arrays(corpus.data):
+        lengths = arrays.lengths('input_ids')[:num_samples]
+        padding = _sample_sums(arrays.buffers['attention_mask'] == 1, arrays.offsets['attention_mask'])[:num_samples]
+        trainable = _trainable_tokens(arrays)[:num_samples]
+
+        num_instance += num_samples
+        num_tokens += int(lengths.sum())
+        padding_tokens += int(padding.sum())
+        trainable_tokens += int(trainable.sum())
+        fully_masked += int(np.count_nonzero(trainable == 0))
+        if max_tokens is not None:
+            # samples cut to the limit and the ones that fit it exactly are alike
+            truncated += int(np.count_nonzero(lengths - padding >= max_tokens))
+
+    content_tokens = num_tokens - padding_tokens
+    ratio = lambda a, b: a / b if b else 0.0
+    result = {
+        "num_instance": num_instance,
+        "num_tokens": num_tokens,
+        "pad_length": processor.pad_length,
+        "pad_side": processor.pad_side,
+        "padding_tokens": padding_tokens,
+        "padding_fraction": ratio(padding_tokens, num_tokens),
+        "max_tokens": max_tokens,
+        "truncated": truncated,
+        "truncated_fraction": ratio(truncated, num_instance),
+        "trainable_tokens": trainable_tokens,
+        "trainable_ratio": ratio(trainable_tokens, content_tokens),
+        "trainable_fraction": ratio(trainable_tokens, num_tokens),
+        "fully_masked": fully_masked,
+        "fully_masked_fraction": ratio(fully_masked, num_instance)}
+
+    if verbose:
+        log_efficiency(result)
+    return result
 
 
-def stat(path_or_corpus):
+def stat(path_or_corpus, efficiency=False, **kwargs):
     if isinstance(path_or_corpus, str):
-        return stat_json_file(path_or_corpus)
+        if efficiency:
+            raise ValueError("the token efficiency is reported for built corpora, not source files")
+        return stat_json_file(path_or_corpus, **kwargs)
     elif isinstance(path_or_corpus, BasicCorpus):
-        return stat_corpus(path_or_corpus)
+        if efficiency:
+            return stat_efficiency(path_or_corpus, **kwargs)
+        return stat_corpus(path_or_corpus, **kwargs)
     else:
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
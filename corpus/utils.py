@@ -1,5 +1,79 @@
 from pygments import console
+import numpy as np
+import hashlib
+import math
+import os
 
 
 def corpus_log(info, **kwargs):
-    print(console.colorize("yellow", "corpus: ") + f"{info}", **kwargs)
\ No newline at end of file
+    print(console.colorize("yellow", "corpus: ") + f"{info}", **kwargs)
+
+
+def split_byte_ranges(path, num_ranges, start=0):
+    size = os.path.getsize(path)
+    bounds = [start]
+
+    with open(path, 'rb') as f:
+        for i in range(1, num_ranges):
+            f.seek(max(start + (size - start) * i // num_ranges - 1, bounds[-1]))
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+
+    if bounds[-1] < size or len(bounds) == 1:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def reservoir_sample(n, k, rng):
+    # Algorithm L: picks k of range(n) uniformly, skipping ahead geometrically
+    if k >= n:
+        return list(range(n))
+
+    reservoir = list(range(k))
+    w = math.exp(math.log(rng.random()) / k)
+    i = k - 1
+    while True:
+        i += math.floor(math.log(rng.random()) / math.log(1 - w)) + 1
+        if i >= n:
+            return reservoir
+        reservoir[rng.randrange(k)] = i
+        w *= math.exp(math.log(rng.random()) / k)
+
+
+def file_fingerprint(path, num_blocks=16, block_size=1 << 16, mtime=True):
+    # size, mtime and a hash of evenly spaced blocks, cheap even for huge files;
+    # without `mtime` only the content counts, e.g. across `cp -p`
+    stat = os.stat(path)
+    key = f"{stat.st_size}/{stat.st_mtime_ns}" if mtime else f"{stat.st_size}"
+    digest = hashlib.sha256(key.encode())
+
+    with open(path, 'rb') as f:
+        if stat.st_size <= num_blocks * block_size:
+            digest.update(f.read())
+        else:
+            step = (stat.st_size - block_size) // (num_blocks - 1)
+            for i in range(num_blocks):
+                f.seek(i * step)
+                digest.update(f.read(block_size))
+
+    return digest.hexdigest()
+
+
+def encode_label_spans(input_ids, labels):
+    # flat [start_0, end_0, start_1, end_1, ...] of the runs where labels == input_ids
+    input_ids, labels = np.asarray(input_ids), np.asarray(labels)
+    trainable = labels != -100
+    if not np.array_equal(labels[trainable], input_ids[trainable]):
+        raise ValueError("labels differ from input_ids and can not be encoded as spans")
+    return np.flatnonzero(np.diff(trainable.astype(np.int8), prepend=0, append=0)).tolist()
+
+
+def expand_label_spans(input_ids, label_spans):
+    input_ids = np.asarray(input_ids, dtype=np.int64)
+    spans = np.asarray(label_spans, dtype=np.int64).reshape(-1, 2)
+
+    delta = np.zeros(len(input_ids) + 1, dtype=np.int64)
+    np.add.at(delta, spans[:, 0], 1)
+    np.add.at(delta, spans[:, 1], -1)
+    return np.where(np.cumsum(delta[:-1]) > 0, input_ids, -100)
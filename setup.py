@@ -4,5 +4,13 @@ setup(
     name='corpus',
     version='1.0',
     packages=['corpus'],
-    install_requires=[]
-)
\ No newline at end of file
+    install_requires=[],
+    extras_require={
+        # faster json parsing and zstd compressed sources
+        'fast': ['orjson', 'pysimdjson', 'zstandard'],
+        # parquet / arrow sources and the arrow cache format
+        'arrow': ['pyarrow'],
+        'all': ['orjson', 'pysimdjson', 'zstandard', 'pyarrow'],
+        'test': ['pytest'],
+    }
+)
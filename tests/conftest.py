@@ -0,0 +1,63 @@
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+import random
+import json
+import pytest
+
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog hello world user assistant "
+    "what is answer please explain why because data model train token").split()
+SPECIAL_TOKENS = ["<unk>", "<s>", "</s>", "<pad>"]
+NUM_RECORDS = 120
+
+
+def make_text(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+@pytest.fixture(scope='session')
+def tokenizer():
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + WORDS)}
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        pad_token="<pad>")
+
+
+@pytest.fixture(scope='session')
+def records():
+    rng = random.Random(0)
+    return [
+        {"input": make_text(rng, 1, 80), "output": make_text(rng, 1, 30), "id": i}
+        for i in range(NUM_RECORDS)]
+
+
+@pytest.fixture(scope='session')
+def jsonl_path(tmp_path_factory, records):
+    path = tmp_path_factory.mktemp("data") / "records.jsonl"
+    with open(path, 'w') as f:
+        for i, record in enumerate(records):
+            f.write(json.dumps(record) + "\n")
+            # blank lines are skipped by every reader
+            if i % 37 == 0:
+                f.write("\n   \n")
+    return str(path)
+
+
+@pytest.fixture(scope='session')
+def concat_config(tmp_path_factory):
+    path = tmp_path_factory.mktemp("config") / "concat.json"
+    config = {
+        "concat": {
+            "input": {"trunc_rear": False, "trunc_txt": None, "train": False},
+            "output": {"trunc_rear": True, "trunc_txt": None, "train": True}},
+        "truncation": {"enable": True, "max_tokens": 64, "order": ["input", "output"]}}
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return str(path)
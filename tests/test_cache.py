@@ -0,0 +1,110 @@
+from corpus import Corpus, ConcatProcessor
+from corpus.cache import CacheWriter, read_meta, pa
+import corpus.corpus
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
+import pytest
+import os
+
+
+FORMATS = ['bin', pytest.param('arrow', marks=pytest.mark.skipif(pa is None, reason="needs pyarrow"))]
+
+
+class CountingProcessor(ConcatProcessor):
+    # counts processed instances, and fails once `fail_after` is reached
+    def __init__(self, *args, fail_after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_after = fail_after
+        self.num_processed = 0
+
+
+    def process_batch(self, instances):
+        if self.fail_after is not None and self.num_processed >= self.fail_after:
+            raise KeyboardInterrupt
+        self.num_processed += len(instances)
+        return super().process_batch(instances)
+
+
+def cache_paths(cache_dir):
+    # cache directories, without their lock files
+    return [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if not name.endswith('.lock')]
+
+
+def to_lists(corpus):
+    return [{key: np.asarray(value).tolist() for key, value in corpus[i].items()} for i in range(len(corpus))]
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(corpus.corpus, 'CacheWriter', partial(CacheWriter, segment_size=8))
+
+
+@pytest.fixture
+def expected(jsonl_path, concat_config, tokenizer):
+    return to_lists(Corpus(jsonl_path, ConcatProcessor(concat_config, tokenizer), use_cache=False))
+
+
+@pytest.mark.parametrize('cache_format', FORMATS)
+def test_resume_after_interrupted_build(
+        small_segments, tmp_path, jsonl_path, concat_config, tokenizer, expected, cache_format):
+    failing = CountingProcessor(concat_config, tokenizer, fail_after=50)
+    with pytest.raises(KeyboardInterrupt):
+        Corpus(jsonl_path, failing, cache_dir=str(tmp_path), batch_size=4, cache_format=cache_format)
+
+    path, = cache_paths(tmp_path)
+    meta = read_meta(path)
+    assert not meta['complete']
+    assert 0 < meta['num_samples'] <= 50
+    assert meta['byte_offset'] > 0
+
+    processor = CountingProcessor(concat_config, tokenizer)
+    resumed = Corpus(jsonl_path, processor, cache_dir=str(tmp_path), batch_size=4, cache_format=cache_format)
+    assert processor.num_processed == len(expected) - meta['num_samples']
+    assert to_lists(resumed) == expected
+    assert read_meta(path)['complete']
+
+    # and a complete cache is loaded without processing
+    processor = CountingProcessor(concat_config, tokenizer)
+    assert to_lists(Corpus(jsonl_path, processor, cache_dir=str(tmp_path), cache_format=cache_format)) == expected
+    assert processor.num_processed == 0
+
+
+def test_prefix_cache_across_max_instance(small_segments, tmp_path, jsonl_path, concat_config, tokenizer, expected):
+    build = lambda processor, max_instance: Corpus(
+        jsonl_path, processor, max_instance=max_instance, cache_dir=str(tmp_path), batch_size=4)
+
+    processor = CountingProcessor(concat_config, tokenizer)
+    first = build(processor, 30)
+    assert to_lists(first) == expected[:30]
+    assert processor.num_processed == 30
+
+    # a smaller request reads the same cache
+    processor = CountingProcessor(concat_config, tokenizer)
+    smaller = build(processor, 10)
+    assert smaller.signature == first.signature
+    assert to_lists(smaller) == expected[:10]
+    assert processor.num_processed == 0
+
+    # a larger one only processes what the cache lacks
+    processor = CountingProcessor(concat_config, tokenizer)
+    assert to_lists(build(processor, None)) == expected
+    assert processor.num_processed == len(expected) - 30
+
+    processor = CountingProcessor(concat_config, tokenizer)
+    assert to_lists(build(processor, 1000)) == expected
+    assert processor.num_processed == 0
+    assert len(cache_paths(tmp_path)) == 1
+
+
+def test_concurrent_builds_share_one_cache(small_segments, tmp_path, jsonl_path, concat_config, tokenizer, expected):
+    processors = [CountingProcessor(concat_config, tokenizer) for _ in range(3)]
+    build = lambda processor: to_lists(Corpus(jsonl_path, processor, cache_dir=str(tmp_path), batch_size=4))
+    with ThreadPoolExecutor(len(processors)) as pool:
+        results = list(pool.map(build, processors))
+
+    # one job builds the cache, the others wait for it and load it
+    assert all(result == expected for result in results)
+    assert sorted(processor.num_processed for processor in processors) == [0, 0, len(expected)]
+    assert len(cache_paths(tmp_path)) == 1
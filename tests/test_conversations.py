@@ -0,0 +1,23 @@
+from corpus.processor.conversations import conv_templates
+
+import random
+import pytest
+
+
+MESSAGES = ["hello there ", "ok\n", "x", "", "fun", "a<n>", " ", "line one\nline two"]
+
+
+@pytest.mark.parametrize('name', sorted(conv_templates))
+def test_pieces_join_to_rendered_prompt(name):
+    template = conv_templates[name]
+    if template.sep_style is None:
+        pytest.skip("template without a separator style")
+
+    renderer = template.get_renderer()
+    system_prompt = template.get_system_prompt()
+    rng = random.Random(name)
+    for _ in range(20):
+        messages = [(template.roles[i % 2], rng.choice(MESSAGES)) for i in range(rng.randint(0, 5))]
+        pieces = renderer.pieces(system_prompt, template.system_message, messages)
+        assert "".join(text for text, _, _ in pieces) == renderer.render(system_prompt, template.system_message, messages)
+        assert all(text for text, _, _ in pieces)
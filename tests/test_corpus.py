@@ -0,0 +1,46 @@
+from corpus import Corpus, ConcatProcessor, StreamingCorpus
+
+import numpy as np
+import shutil
+import gzip
+import pytest
+
+
+def to_lists(corpus):
+    return [{key: np.asarray(value).tolist() for key, value in corpus[i].items()} for i in range(len(corpus))]
+
+
+@pytest.fixture(params=['jsonl', 'gz'])
+def source(request, tmp_path, jsonl_path):
+    # plain jsonl is split into byte ranges, gzip streams go through batches
+    if request.param == 'jsonl':
+        return jsonl_path
+    path = str(tmp_path / "records.jsonl.gz")
+    with open(jsonl_path, 'rb') as src, gzip.open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    return path
+
+
+@pytest.mark.parametrize('max_instance', [None, 7, 50, 119, 1000])
+def test_parallel_build_matches_serial(source, records, concat_config, tokenizer, max_instance):
+    build = lambda num_workers: to_lists(Corpus(
+        source, ConcatProcessor(concat_config, tokenizer), max_instance=max_instance,
+        use_cache=False, batch_size=4, num_workers=num_workers))
+
+    serial = build(1)
+    assert len(serial) == min(len(records), max_instance or len(records))
+    assert build(4) == serial
+
+
+@pytest.mark.parametrize('max_instance', [None, 50])
+@pytest.mark.parametrize('num_shards', [3, 7])
+def test_streaming_shards_are_even(monkeypatch, source, records, concat_config, tokenizer, num_shards, max_instance):
+    processor = ConcatProcessor(concat_config, tokenizer)
+    corpus = StreamingCorpus(source, processor, max_instance=max_instance, batch_size=4)
+    uneven = [len(list(corpus.iter_samples(i, num_shards))) for i in range(num_shards)]
+    assert sum(uneven) == min(len(records), max_instance or len(records))
+
+    # under DDP every shard stops at the size of the smallest one
+    monkeypatch.setattr(StreamingCorpus, 'even_shards', True)
+    even = [len(list(corpus.iter_samples(i, num_shards))) for i in range(num_shards)]
+    assert even == [min(uneven)] * num_shards
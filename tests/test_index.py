@@ -0,0 +1,33 @@
+from corpus.reader import open_reader
+from corpus.index import open_index, build_line_offsets, INDEX_SUFFIX
+
+import numpy as np
+import json
+import os
+
+
+def test_line_offsets_skip_whitespace_lines(tmp_path):
+    path = tmp_path / "blank.jsonl"
+    path.write_bytes(b'{"a": 1}\n' + b' ' * 30 + b'\n\t\r\n{"a": 2}\n   ')
+    offsets = build_line_offsets(str(path)).tolist()
+    assert offsets == [0, 9 + 31 + 3]
+
+
+def test_line_index_rebuilt_for_partial_or_stale_sidecar(tmp_path):
+    path = tmp_path / "records.jsonl"
+    path.write_text("".join(json.dumps({"a": i}) + "\n" for i in range(100)))
+    assert len(open_index(open_reader(str(path)))) == 100
+
+    # a partially written sidecar
+    sidecar = str(path) + INDEX_SUFFIX
+    raw = np.fromfile(sidecar, dtype=np.uint64)
+    raw[:40].tofile(sidecar)
+    assert len(open_index(open_reader(str(path)))) == 100
+
+    # the source rewritten with its mtime kept
+    stat = os.stat(path)
+    path.write_text("".join(json.dumps({"bb": i}) + "\n" for i in range(50)))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    index = open_index(open_reader(str(path)))
+    assert len(index) == 50
+    assert index[49] == {"bb": 49}
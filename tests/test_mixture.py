@@ -0,0 +1,98 @@
+from corpus import MixtureCorpus, StreamingMixtureCorpus
+
+from torch.utils.data import IterableDataset
+from collections import Counter
+import numpy as np
+import pytest
+
+
+class Source(list):
+    def lengths(self):
+        return np.array([len(sample) for sample in self], dtype=np.int64)
+
+
+class StreamingSource(IterableDataset):
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+    def __iter__(self):
+        return iter((self.name, i) for i in range(self.size))
+
+
+def make_sources():
+    return [Source(["a" * (i % 7 + 1) for i in range(100)]), Source(["b" * (i % 5 + 1) for i in range(10)])]
+
+
+def test_counts_follow_weights():
+    mixture = MixtureCorpus(make_sources(), weights=[3, 1], num_samples=1000, seed=0)
+    assert len(mixture) == 1000
+    assert np.bincount(mixture.sources).tolist() == [750, 250]
+
+    # the small source is up-sampled by repeating its indices, evenly
+    counts = Counter(mixture.indices[mixture.sources == 1].tolist())
+    assert sorted(counts) == list(range(10))
+    assert set(counts.values()) == {25}
+
+    counts = Counter(mixture.indices[mixture.sources == 0].tolist())
+    assert sorted(counts) == list(range(100))
+    assert set(counts.values()) <= {7, 8}
+
+
+def test_default_weights_take_every_sample_once():
+    mixture = MixtureCorpus(make_sources(), seed=0)
+    pairs = sorted(zip(mixture.sources.tolist(), mixture.indices.tolist()))
+    assert pairs == [(0, i) for i in range(100)] + [(1, i) for i in range(10)]
+
+
+def test_deterministic_per_seed_and_epoch():
+    make = lambda seed: MixtureCorpus(make_sources(), weights=[1, 1], num_samples=300, seed=seed)
+    a, b, c = make(0), make(0), make(1)
+    assert [a[i] for i in range(300)] == [b[i] for i in range(300)]
+    assert (a.sources != c.sources).any()
+
+    sources = a.sources.copy()
+    a.set_epoch(1)
+    assert (a.sources != sources).any()
+    a.set_epoch(0)
+    assert (a.sources == sources).all()
+
+
+def test_items_and_lengths_come_from_sources():
+    sources = make_sources()
+    mixture = MixtureCorpus(sources, weights=[1, 2], num_samples=90, shuffle=False)
+    for i in range(len(mixture)):
+        assert mixture[i] == sources[mixture.sources[i]][mixture.indices[i]]
+    assert mixture.lengths().tolist() == [len(mixture[i]) for i in range(len(mixture))]
+    # without shuffling every third sample comes from the first source
+    assert mixture.sources.tolist() == [1, 0, 1] * 30
+
+
+def test_invalid_weights():
+    with pytest.raises(ValueError):
+        MixtureCorpus(make_sources(), weights=[1])
+    with pytest.raises(ValueError):
+        MixtureCorpus(make_sources(), weights=[0, 0])
+    with pytest.raises(ValueError):
+        MixtureCorpus([Source(), Source(["a"])], weights=[1, 1])
+
+
+def test_streaming_mixture():
+    sources = [StreamingSource("a", 300), StreamingSource("b", 20)]
+    samples = list(StreamingMixtureCorpus(sources, weights=[0.75, 0.25], seed=0))
+    assert samples == list(StreamingMixtureCorpus(sources, weights=[0.75, 0.25], seed=0))
+
+    # every source is seen in full, the small one restarted
+    counts = Counter(name for name, _ in samples)
+    assert {("a", i) for i in range(300)} <= set(samples)
+    assert {("b", i) for i in range(20)} <= set(samples)
+    assert counts["b"] > 20
+
+    limited = list(StreamingMixtureCorpus(sources, weights=[0.75, 0.25], max_instance=50))
+    assert len(limited) == 50
+
+
+def test_streaming_mixture_skips_empty_sources():
+    sources = [StreamingSource("a", 30), StreamingSource("b", 0)]
+    assert len(list(StreamingMixtureCorpus(sources))) == 30
@@ -0,0 +1,48 @@
+from corpus import Corpus, ConcatProcessor, PackedCorpus
+from corpus.packing import best_fit_decreasing
+
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_best_fit_decreasing(seed):
+    lengths = np.random.default_rng(seed).integers(1, 120, size=300)
+    capacity = 100
+    bins = best_fit_decreasing(lengths, capacity)
+
+    assert sorted(i for row in bins for i in row) == list(range(len(lengths)))
+    fills = [int(np.minimum(lengths[row], capacity).sum()) for row in bins]
+    assert max(fills) <= capacity
+    # best fit decreasing needs at most 11/9 OPT + 1 bins
+    lower_bound = int(np.ceil(np.minimum(lengths, capacity).sum() / capacity))
+    assert len(bins) <= 11 / 9 * lower_bound + 1
+
+
+def test_best_fit_decreasing_fills_exact_pairs():
+    bins = best_fit_decreasing(np.array([6, 4, 7, 3, 5, 5]), 10)
+    assert len(bins) == 3
+
+
+@pytest.mark.parametrize('pad_side', ['left', 'right'])
+def test_cu_seqlens(jsonl_path, concat_config, tokenizer, pad_side):
+    processor = ConcatProcessor(concat_config, tokenizer, pad_side=pad_side)
+    corpus = Corpus(jsonl_path, processor, use_cache=False)
+    packed = PackedCorpus(corpus, pad_length=96)
+    lengths = corpus.lengths()
+
+    for index in range(len(packed)):
+        row = packed[index]
+        cu_seqlens = np.asarray(row['cu_seqlens'])
+        mask = np.asarray(row['attention_mask'])
+        assert len(row['input_ids']) == len(row['labels']) == len(mask) == 96
+
+        # documents lie back to back between the padding
+        expected = [min(lengths[i], 96) for i in packed.rows[index]]
+        assert np.diff(cu_seqlens).tolist() == expected
+        assert (mask[cu_seqlens[0]:cu_seqlens[-1]] == 0).all()
+        assert mask.sum() == 96 - sum(expected)
+
+        for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:]):
+            assert row['position_ids'][start:end] == list(range(end - start))
+            assert row['labels'][start] == -100
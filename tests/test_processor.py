@@ -0,0 +1,138 @@
+from corpus import ConcatProcessor, ConversationProcessor
+from corpus.processor.conversations import conv_templates
+from conftest import SPECIAL_TOKENS, WORDS
+
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+import json
+import pytest
+
+
+MESSAGES = [
+    {"role": "user", "content": "hello what is the answer"},
+    {"role": "assistant", "content": "the answer is data"},
+    {"role": "user", "content": "please explain why"},
+    {"role": "assistant", "content": "because the model"}]
+
+
+@pytest.fixture
+def conv_config(tmp_path):
+    def make(check_tokenization=None, conv_template="vicuna_v1.1", max_tokens=None):
+        path = tmp_path / f"conv-{check_tokenization}-{max_tokens}.json"
+        config = {
+            "conversation": {
+                "conv_template": conv_template,
+                "conv_keyword": "conversations",
+                "role_keyword": "role",
+                "cont_keyword": "content",
+                "roles": {"user": 0, "assistant": 1},
+                "check_tokenization": check_tokenization},
+            "truncation": {"enable": max_tokens is not None, "max_tokens": max_tokens}}
+        if check_tokenization is None:
+            del config["conversation"]["check_tokenization"]
+        path.write_text(json.dumps(config))
+        return str(path)
+    return make
+
+
+@pytest.fixture
+def merging_tokenizer():
+    # words are only split at whitespace, so a message and the chatml
+    # separator closing it make a single token
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + WORDS)}
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, eos_token="</s>", unk_token="<unk>", pad_token="<pad>")
+
+
+def prompt_of(processor, instance):
+    template = conv_templates[processor.config.conversation.conv_template]
+    pieces = processor.pieces(template, processor.render(template, instance))
+    return "".join(text for text, _, _ in pieces)
+
+
+def test_piece_ids_kept_when_tokenization_matches(conv_config, tokenizer):
+    processor = ConversationProcessor(conv_config(True), tokenizer)
+    assert not processor.whole_prompt
+
+    instance = {"conversations": MESSAGES}
+    sample = processor.process(instance)
+    assert sample['input_ids'] == tokenizer(prompt_of(processor, instance)).input_ids
+
+
+@pytest.mark.parametrize('check_tokenization', [False, True])
+def test_whole_prompt_fallback(conv_config, merging_tokenizer, check_tokenization):
+    processor = ConversationProcessor(conv_config(check_tokenization, "qwen-7b-chat"), merging_tokenizer)
+    assert processor.whole_prompt == check_tokenization
+
+    instance = {"conversations": MESSAGES}
+    sample = processor.process(instance)
+    expected = merging_tokenizer(prompt_of(processor, instance)).input_ids
+    assert (sample['input_ids'] == expected) == check_tokenization
+
+    if check_tokenization:
+        # assistant words and the separators closing them are trained
+        vocab = merging_tokenizer.get_vocab()
+        trained = [token for token, label in zip(sample['input_ids'], sample['labels']) if label != -100]
+        assert trained[:3] == [vocab["the"], vocab["answer"], vocab["is"]]
+        assert vocab["hello"] not in trained
+
+
+def test_check_tokenization_by_default(conv_config, merging_tokenizer):
+    processor = ConversationProcessor(conv_config(conv_template="qwen-7b-chat"), merging_tokenizer)
+    assert processor.config.conversation.check_tokenization
+    assert processor.whole_prompt
+
+
+def test_whole_prompt_fallback_on_real_batch(conv_config, merging_tokenizer, monkeypatch):
+    # probes that pass, the merge only shows on real samples
+    monkeypatch.setattr("corpus.processor.proc_conv.PROBE_MESSAGES", [])
+    processor = ConversationProcessor(conv_config(True, "qwen-7b-chat"), merging_tokenizer)
+    assert not processor.whole_prompt
+
+    instances = [{"conversations": MESSAGES}, {"conversations": MESSAGES[:2]}]
+    samples = processor.process_batch(instances)
+    assert processor.whole_prompt
+    for instance, sample in zip(instances, samples):
+        assert sample['input_ids'] == merging_tokenizer(prompt_of(processor, instance)).input_ids
+
+
+def test_concat_batch_matches_single(concat_config, tokenizer, records):
+    processor = ConcatProcessor(concat_config, tokenizer)
+    batch = processor.process_batch(records)
+    assert batch == [processor.process(record) for record in records]
+
+    # short samples and samples truncated to `max_tokens` alike
+    lengths = {len(sample['input_ids']) for sample in batch}
+    assert 64 in lengths and min(lengths) < 64
+
+
+@pytest.mark.parametrize('tokenizer_name, conv_template', [
+    ('tokenizer', 'vicuna_v1.1'),
+    ('merging_tokenizer', 'qwen-7b-chat')])
+def test_conversation_batch_matches_single(request, conv_config, tokenizer_name, conv_template):
+    tokenizer = request.getfixturevalue(tokenizer_name)
+    instances = [{"conversations": MESSAGES[:n]} for n in (2, 4, 2, 4)]
+
+    # truncated between the shortest and the longest sample
+    full = ConversationProcessor(conv_config(True, conv_template), tokenizer).process_batch(instances)
+    max_tokens = (len(full[0]['input_ids']) + len(full[1]['input_ids'])) // 2
+
+    processor = ConversationProcessor(conv_config(True, conv_template, max_tokens=max_tokens), tokenizer)
+    batch = processor.process_batch(instances)
+    assert batch == [processor.process(instance) for instance in instances]
+    assert [len(sample['input_ids']) < max_tokens for sample in batch] == [True, False, True, False]
+
+
+@pytest.mark.parametrize('trunc_rear', [True, False])
+@pytest.mark.parametrize('budget', [1, 5, 64])
+def test_chunked_tokenize_matches_full(concat_config, tokenizer, records, trunc_rear, budget):
+    processor = ConcatProcessor(concat_config, tokenizer)
+    # texts from a few words to many times the first chunk
+    texts = [record["input"] for record in records] + [" ".join(WORDS * n) for n in (1, 10, 40)]
+
+    # texts that fit the first chunk come back whole, the others as their kept end
+    kept = lambda input_ids: input_ids[:budget] if trunc_rear else input_ids[max(len(input_ids) - budget, 0):]
+    chunked = processor.tokenize(texts, budget, trunc_rear)
+    full = tokenizer(texts, add_special_tokens=False).input_ids
+    assert [kept(input_ids) for input_ids in chunked] == [kept(input_ids) for input_ids in full]
@@ -0,0 +1,102 @@
+from corpus.reader import JsonlReader, get_backend, open_reader, orjson, pa, simdjson, zstandard
+from corpus.index import open_index
+
+import gzip
+import json
+import pytest
+
+
+BACKENDS = [
+    'json',
+    pytest.param('orjson', marks=pytest.mark.skipif(orjson is None, reason="needs orjson")),
+    pytest.param('simdjson', marks=pytest.mark.skipif(simdjson is None, reason="needs pysimdjson"))]
+
+
+SOURCES = [
+    'jsonl',
+    'gz',
+    pytest.param('zst', marks=pytest.mark.skipif(zstandard is None, reason="needs zstandard")),
+    pytest.param('parquet', marks=pytest.mark.skipif(pa is None, reason="needs pyarrow")),
+    pytest.param('arrow', marks=pytest.mark.skipif(pa is None, reason="needs pyarrow"))]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_backends_agree(jsonl_path, records, backend):
+    assert list(JsonlReader(jsonl_path, backend=backend)) == records
+    projected = JsonlReader(jsonl_path, fields=['id', 'output'], backend=backend)
+    assert list(projected) == [{"id": record["id"], "output": record["output"]} for record in records]
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_backend('ujson')
+
+
+def write_source(jsonl_path, records, kind, directory):
+    if kind == 'jsonl':
+        return jsonl_path
+    with open(jsonl_path, 'rb') as f:
+        raw = f.read()
+
+    path = str(directory / f"records.{kind}" if kind in ('parquet', 'arrow') else directory / f"records.jsonl.{kind}")
+    if kind == 'gz':
+        with gzip.open(path, 'wb') as f:
+            f.write(raw)
+    elif kind == 'zst':
+        with open(path, 'wb') as f:
+            f.write(zstandard.ZstdCompressor().compress(raw))
+    elif kind == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(pa.Table.from_pylist(records), path, row_group_size=16)
+    else:
+        table = pa.Table.from_pylist(records)
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=16)
+    return path
+
+
+@pytest.fixture(params=SOURCES)
+def source(request, tmp_path, jsonl_path, records):
+    return write_source(jsonl_path, records, request.param, tmp_path)
+
+
+def test_records(source, records):
+    assert list(open_reader(source)) == records
+    assert list(open_reader(source, fields=['id'])) == [{"id": record["id"]} for record in records]
+
+
+def test_resume_from_position(source, records):
+    reader = open_reader(source)
+    positions = [position for position, _ in reader.iter_records()]
+    for i in (0, 1, 40, len(records) - 1):
+        assert [instance for _, instance in reader.iter_records(positions[i])] == records[i + 1:]
+
+
+@pytest.mark.parametrize('num_shards', [1, 3, 7])
+def test_shards_partition_records(source, records, num_shards):
+    reader = open_reader(source)
+    shards = [list(reader.iter_shard(i, num_shards)) for i in range(num_shards)]
+    key = lambda record: record["id"]
+    assert sorted((record for shard in shards for record in shard), key=key) == records
+
+
+def test_split_ranges(source, records):
+    reader = open_reader(source)
+    ranges = reader.split_ranges(5)
+    if ranges is None:
+        # compressed streams can not be split
+        return
+    assert [instance for start, end in ranges for _, instance in reader.iter_records(start, end)] == records
+
+
+def test_random_access(source, records):
+    reader = open_reader(source)
+    if not reader.seekable:
+        with pytest.raises(ValueError):
+            open_index(reader)
+        return
+    index = open_index(reader)
+    assert len(index) == len(records)
+    for i in (0, 17, 16, 64, len(records) - 1):
+        assert index[i] == records[i]
+
@@ -0,0 +1,56 @@
+from corpus import ConcatProcessor, LazyRandomSampleCorpus, LengthGroupedBatchSampler, ResampleSampler
+
+from torch.utils.data import DataLoader
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('max_batch_size', [None, 4])
+def test_batches_fit_token_budget(max_batch_size):
+    lengths = np.random.default_rng(0).integers(1, 300, size=2000)
+    sampler = LengthGroupedBatchSampler(lengths, max_tokens=1024, max_batch_size=max_batch_size, group_size=256)
+    batches = list(sampler)
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) * lengths[batch].max() <= 1024
+        if max_batch_size is not None:
+            assert len(batch) <= max_batch_size
+
+
+def test_oversized_samples_get_their_own_batch():
+    sampler = LengthGroupedBatchSampler(np.array([5000, 10, 10]), max_tokens=1024)
+    assert sorted(map(sorted, sampler)) == [[0], [1, 2]]
+
+
+def test_batches_depend_on_seed_and_epoch():
+    lengths = np.random.default_rng(1).integers(1, 300, size=500)
+    make = lambda seed, epoch: LengthGroupedBatchSampler(lengths, 2048, seed=seed).make_batches(epoch)
+    assert make(0, 0) == make(0, 0)
+    assert make(0, 0) != make(0, 1)
+    assert make(0, 0) != make(1, 0)
+
+
+def test_resample_sampler_shards_ranks():
+    full = ResampleSampler(50, 103, seed=3).draw(0).tolist()
+    shards = [list(ResampleSampler(50, 103, seed=3, num_replicas=4, rank=rank)) for rank in range(4)]
+
+    assert [len(shard) for shard in shards] == [26] * 4
+    interleaved = [shard[i] for i in range(26) for shard in shards]
+    assert interleaved[:103] == full
+    assert interleaved[103:] == full[:1]
+
+
+def test_lazy_random_sample_corpus_iterates_its_sampler(jsonl_path, concat_config, tokenizer):
+    processor = ConcatProcessor(concat_config, tokenizer)
+    corpus = LazyRandomSampleCorpus(jsonl_path, processor, max_instance=50, seed=1, use_cache=False)
+    loader = DataLoader(corpus, sampler=corpus.sampler, batch_size=None)
+
+    epochs = []
+    for epoch in range(2):
+        corpus.set_epoch(epoch)
+        lines = corpus.sampler.draw(epoch).tolist()
+        samples = list(loader)
+        assert samples == [processor.process(corpus.data[line]) for line in lines]
+        epochs.append(lines)
+    assert epochs[0] != epochs[1]
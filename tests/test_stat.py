@@ -0,0 +1,51 @@
+from corpus.stat import Aggregate, StatState, stat_json_file
+
+import numpy as np
+import json
+import pytest
+
+
+def test_percentiles_within_observed_range():
+    aggregate = Aggregate()
+    aggregate.add([1, 2.5])
+    summary = aggregate.summary()
+    for p in (50, 90, 99):
+        assert 1 <= summary[f"p{p}"] <= 2.5
+
+
+def test_percentiles_relative_error():
+    values = np.random.default_rng(0).lognormal(5, 2, size=10000)
+    aggregate = Aggregate()
+    aggregate.add(values)
+    summary = aggregate.summary()
+    for p in (50, 90, 99):
+        exact = np.percentile(values, p, method='lower')
+        assert abs(summary[f"p{p}"] - exact) <= 0.02 * exact
+
+
+def test_histogram_bins():
+    aggregate = Aggregate(histogram=True)
+    aggregate.add([0, 1, 2, 3, 4, 1000])
+    assert aggregate.summary()["histogram"] == [(0, 0, 1), (1, 1, 1), (2, 3, 2), (4, 7, 1), (512, 1023, 1)]
+
+
+def test_merged_states_equal_one_pass():
+    rng = np.random.default_rng(1)
+    instances = [{"text": "x" * int(n), "score": float(n)} for n in rng.integers(0, 500, size=300)]
+    whole, left, right = StatState(), StatState(), StatState()
+    for i, instance in enumerate(instances):
+        whole.add(instance)
+        (left if i < 100 else right).add(instance)
+    assert left.merge(right).result() == whole.result()
+
+
+@pytest.mark.parametrize('num_workers', [1, 3])
+def test_json_file_result_is_serializable(jsonl_path, records, num_workers):
+    result = stat_json_file(jsonl_path, num_workers=num_workers, verbose=False)
+    json.dumps(result)
+
+    assert result["num_instance"] == len(records)
+    text = result["fields"]["input"]
+    assert text["missing"] == 0
+    assert text["length"]["max"] == max(len(record["input"]) for record in records)
+    assert result["fields"]["id"]["value"]["min"] == 0